@@ -10,12 +10,14 @@ import pathlib
 scriptPath = pathlib.Path(__file__).parent.resolve()
 sys.path.append(str(scriptPath.parent / 'common'))
 from jsonutils import json2str
+from analysis import analysis_gray, scale_area, large_regions, to_display
 
 
 class TesterDetection(object):
-    def __init__(self, file, redis_conn, id, detectionType=1) -> None:
+    def __init__(self, file, redis_conn, id, detectionType=1, analysisScale=1.0, displayVid=True) -> None:
         ''' init tester detection module'''
         self.redis_conn = redis_conn
+        self.display_video = displayVid
         self.detType = detectionType
         self.id = id
         self.alert = False
@@ -35,8 +37,9 @@ class TesterDetection(object):
         self.fps_stop = 0
         self.prev_frame_time = 0
 
-        # minimum area contour
+        # minimum area contour, in capture pixels
         self.min_area = 2000
+        self.scale = analysisScale
 
         # on off flags
         self.flag = False
@@ -176,7 +179,8 @@ class TesterDetection(object):
         ''' masking and comparison thread '''
         # save previous frame and convert to grayscale
         ret, prev_frame = self.cap.read()
-        self.prev_frame_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY) if ret else None
+        self.prev_frame_gray = analysis_gray(prev_frame, self.scale) if ret else None
+        min_area = scale_area(self.min_area, self.scale)
 
         while True:
 
@@ -191,18 +195,18 @@ class TesterDetection(object):
             if not ret:
                 break
 
-            current_frame_gray = cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY)
+            current_frame_gray = analysis_gray(current_frame, self.scale)
             frame_diff = cv2.absdiff(current_frame_gray, self.prev_frame_gray)
             _, thresh_diff = cv2.threshold(frame_diff, self.threshold, 255, cv2.THRESH_BINARY)
 
+            # thresholds are fractions of the analysed pixels
             nonzero_pixels = cv2.countNonZero(thresh_diff)
-            significant_change_threshold = (self.frame_width * self.frame_height) * 0.001
-            full_screen_change = (self.frame_width * self.frame_height) * 0.5
-            minor_change_threshold = (self.frame_width * self.frame_height) * 0.0001
-            mouse_change_threshold = (self.frame_width * self.frame_height) * 0.0005
+            significant_change_threshold = current_frame_gray.size * 0.001
+            full_screen_change = current_frame_gray.size * 0.5
+            minor_change_threshold = current_frame_gray.size * 0.0001
+            mouse_change_threshold = current_frame_gray.size * 0.0005
 
-            contours, _ = cv2.findContours(thresh_diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            significant_change_detected = any(cv2.contourArea(contour) > self.min_area for contour in contours)
+            significant_change_detected, _ = large_regions(thresh_diff, min_area)
 
             self.capture_test_screen(nonzero_pixels, full_screen_change)
 
@@ -212,7 +216,14 @@ class TesterDetection(object):
 
             # print(self.flag)
 
-            # Insert display and frame writing logic here as necessary
+            self.prev_frame_gray = current_frame_gray
+
+            if self.th_quit.is_set():
+                break
+
+            # headless runs skip all display work
+            if not self.display_video:
+                continue
 
             if self.current_state == 1:
                 self.display_text = 'State 3: Alarm'
@@ -221,7 +232,7 @@ class TesterDetection(object):
                 self.display_text = 'State 4: No Alarm'
                 self.text_color = (0, 255, 0)
 
-            thresh_diff_bgr = cv2.cvtColor(thresh_diff, cv2.COLOR_GRAY2BGR)
+            thresh_diff_bgr = to_display(thresh_diff, current_frame)
             cv2.putText(current_frame, self.display_text, (400, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.7, self.text_color, 2)
             # cv2.putText(current_frame, frame_time_text, (800, 70), cv2.FONT_HERSHEY_SIMPLEX, 1.8, (255, 165, 0), 2)
             concatenated_frame = cv2.hconcat([current_frame, thresh_diff_bgr])
@@ -229,17 +240,12 @@ class TesterDetection(object):
             # Show the frame
             cv2.imshow('Original and Significant Changes', concatenated_frame)
 
-            self.prev_frame_gray = current_frame_gray
-
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
-            # Cleanup
-            self.cap.release()
-            cv2.destroyAllWindows()
-
-            if self.th_quit.is_set():
-                break
+        # Cleanup
+        self.cap.release()
+        if self.display_video: cv2.destroyAllWindows()
 
     def start_mask_compare(self):
         ''' start masking and compare '''
@@ -5,29 +5,66 @@
 This is wrapper for algo detection
 '''
 import sys
+import time
 import logging
 import pathlib
+import argparse
 import threading
+import multiprocessing as mp
 import serial
 
 from plugin_module import PluginModule
 from final_algo import TesterDetection
+from eventlog import start_queue_logging, stop_queue_logging
 
 scriptPath = pathlib.Path(__file__).parent.resolve()
 sys.path.append(str(scriptPath.parent / 'common'))
 import argsutils as au
 from jsonutils import json2str
 
+# lifecycle transitions driven by response msg: stage -> (allowed states, next state)
+LIFECYCLE = {
+    'init': (('idle', 'configured', 'captured'), 'configured'),
+    'beginCapture': (('configured',), 'captured'),
+    'testScreen': (('captured',), 'detecting'),
+}
+
 class AlgoWrapper(PluginModule):
     def __init__ (self, args, **kw) -> None:
         ''' init module'''
         self.id = 'vid{}'.format(args.id)
         self.algo = None
+        self.source = kw.pop('source', args.source[0])
+        self.restarts = kw.pop('restarts', 0)
+        self.status_period = args.status_period
+        self.algo_kw = {
+            'previewPeriod': args.preview_period,
+            'previewDir': args.preview_dir,
+            'confirmPopup': args.confirm_popup,
+            'idleFps': args.idle_fps,
+            'captureBackend': args.backend,
+            'captureOptions': {
+                'width': args.width,
+                'height': args.height,
+                'fourcc': args.fourcc,
+                'buffer_size': args.capture_buffer,
+            },
+            'startTime': args.start_time,
+            'instrument': args.instrument,
+            'diffEngine': args.engine,
+            'hashSkip': args.hash_skip,
+        }
+        self.lifecycle = 'idle'
+        self.pending = []
+        self.cond = threading.Condition()
+        self.th_quit = threading.Event()
         self.subscribe_channels = [
             'tester.{}.response'.format(self.id),
             'tester.{}.alert-response'.format(self.id),
         ]
         self.redis_conn = au.connect_redis_with_args(args)
+        # one info key per tester, workers of a supervisor must not share module.base-module.info
+        self.component_name = 'algo-{}'.format(self.id)
 
         PluginModule.__init__(self,
             redis_conn=self.redis_conn
@@ -37,9 +74,48 @@ class AlgoWrapper(PluginModule):
     
     def start (self):
         ''' start wrapper '''
-        self.th_quit = threading.Event()
         self.th = threading.Thread(target=self.wrapper)
         self.th.start()
+        self.start_thread('status', self.status_update)
+        # the controller sends init once at its start, a restarted worker replays the handshake from init itself
+        # beginCapture and testScreen follow from the controller responses to our results
+        if self.restarts:
+            logging.info('Worker {} restarted {} times, requesting init'.format(self.id, self.restarts))
+            self._request_stage('init')
+
+    def get_info (self):
+        ''' module info with the instrumentation summary of the detection loop '''
+        ret = PluginModule.get_info(self)
+        ret.update({
+            'tester-id': self.id,
+            'source': self.source,
+            'lifecycle': self.lifecycle,
+        })
+        if self.algo is not None and self.algo.instr.enabled:
+            ret['instrumentation'] = self.algo.instr.summary()
+        return ret
+
+    def status_update (self):
+        ''' publish detection frame rate on status channel every {status_period} seconds
+            the module info key is refreshed at the same period
+        '''
+        _frames, _time = 0, time.monotonic()
+        while not self.is_quit(self.status_period):
+            if self.algo is None: continue
+            _status = self.algo.get_status()
+            _now = time.monotonic()
+            _status.update({
+                'module': 'algo',
+                'source': self.source,
+                'fps': round((_status['frames'] - _frames) / (_now - _time), 2),
+                'restarts': self.restarts,
+            })
+            _frames, _time = _status['frames'], _now
+            self.redis_conn.publish(
+                'tester.{}.status'.format(self.id),
+                json2str(_status)
+            )
+            self.save_info()
     
 #def read_from_usb(self, port='/dev/ttyUSB0/', baudrate=9600, timeout=1):
        # with serial.Serial(port, baudrate, timeout=timeout) as ser:
@@ -48,18 +124,43 @@ class AlgoWrapper(PluginModule):
             #return data
     
     def wrapper (self):
-        ''' wrapper to start algo code in thread'''
+        ''' wrapper to start algo code in thread
+            blocks until a lifecycle stage is requested by process_redis_msg() or close
+        '''
+        # self.algo = TesterDetection('/Users/juneyoungseo/Documents/Panasonic/test_videos/2023-12-29 08-08-11 SDU CT Tester.mp4', self.redis_conn, self.id)
+        self.algo = TesterDetection(self.source, self.redis_conn, self.id, **self.algo_kw)
+        #self.algo = TesterDetection(read_from_usb, self.redis_conn, self.id)))
+
         while True:
-            if self.algo is None:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.th_quit.is_set())
+                if self.th_quit.is_set():
+                    break
+                _stage = self.pending.pop(0)
+            self._run_stage(_stage)
 
-                # self.algo = TesterDetection('/Users/juneyoungseo/Documents/Panasonic/test_videos/2023-12-29 08-08-11 SDU CT Tester.mp4', self.redis_conn, self.id)
-                self.algo = TesterDetection("/dev/video0", self.redis_conn, self.id)
-                #self.algo = TesterDetection(read_from_usb, self.redis_conn, self.id)))
+        self.algo.close()
 
-            if self.th_quit.is_set():
+    def _request_stage (self, stage):
+        ''' queue lifecycle stage for wrapper thread '''
+        with self.cond:
+            self.pending.append(stage)
+            self.cond.notify()
 
-                self.algo.close()
-                break
+    def _run_stage (self, stage):
+        ''' run lifecycle stage on wrapper thread if allowed by current state '''
+        _allowed, _next = LIFECYCLE[stage]
+        if self.lifecycle not in _allowed:
+            logging.error('Stage {} ignored in lifecycle state {}'.format(stage, self.lifecycle))
+            return
+        if stage == 'init':
+            self.algo.load_configuration()
+        elif stage == 'beginCapture':
+            self.algo.capture_test_screen()
+        elif stage == 'testScreen':
+            self.algo.start_mask_compare()
+        logging.debug('Lifecycle state {} -> {}'.format(self.lifecycle, _next))
+        self.lifecycle = _next
 
     # def start_algo(self):
     #     self.algo = TesterDetection('/Users/juneyoungseo/Documents/Panasonic/test_videos/2023-12-26 10-36-47-ex2 SDU CT Tester.mp4', self.redis_conn, self.id)
@@ -68,7 +169,7 @@ class AlgoWrapper(PluginModule):
     def process_redis_msg (self, ch, msg):
         ''' process redis msg '''
         if ch in self.subscribe_channels:
-            print (ch, msg)
+            logging.debug('{}: {}'.format(ch, msg))
             if ch == 'tester.{}.response'.format(self.id):
                 self._process_response_msg(msg)
             if ch == 'tester.{}.alert-response'.format(self.id):
@@ -86,6 +187,9 @@ class AlgoWrapper(PluginModule):
 
     def _process_alert_response_msg (self, msg):
         ''' process alert response msg '''
+        if self.lifecycle != 'detecting':
+            logging.error('Alert response ignored in lifecycle state {}'.format(self.lifecycle))
+            return
         _stage = msg.get('stage', 'error')
         if _stage == 'alert-reset':
             self._response_alert_reset(msg)
@@ -97,7 +201,7 @@ class AlgoWrapper(PluginModule):
         _status = msg.get('status', 'failed')
 
         if _status == 'success':
-            self.algo.load_configuration()
+            self._request_stage('init')
         else:
             logging.error("Initialization Process Failed...")
 
@@ -106,7 +210,7 @@ class AlgoWrapper(PluginModule):
         _status = msg.get('status', 'failed')
 
         if _status == 'success':
-            self.algo.capture_test_screen()
+            self._request_stage('beginCapture')
         else:
             logging.error("Capturing Process Failed...")
 
@@ -114,7 +218,7 @@ class AlgoWrapper(PluginModule):
         _status = msg.get('status', 'failed')
 
         if _status == 'success':
-            self.algo.start_mask_compare()
+            self._request_stage('testScreen')
         else:
             logging.error("Test Screen Process Failed...")
 
@@ -136,7 +240,87 @@ class AlgoWrapper(PluginModule):
     #     self.algo.close()
     def algo_close (self):
         ''' close the module '''
-        self.th_quit.set()
+        with self.cond:
+            self.th_quit.set()
+            self.cond.notify()
+
+def run_algo_worker (args, source, restarts, quit_evt):
+    ''' process entry for a single tester detection worker '''
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='[%(asctime)s %(processName)s %(levelname)s]: %(message)s',
+    )
+    listener = start_queue_logging(rate=args.log_rate)
+    alw = AlgoWrapper(args=args, source=source, restarts=restarts)
+    alw.start()
+    try:
+        # a failed detection thread ends the process with an error so the supervisor restarts it
+        while not quit_evt.wait(1):
+            if alw.algo is not None and alw.algo.failed:
+                logging.error('Detection of vid{} failed, worker exits'.format(args.id))
+                break
+    except KeyboardInterrupt:
+        pass
+    failed = alw.algo is not None and alw.algo.failed
+    alw.algo_close()
+    alw.close()
+    stop_queue_logging(listener)
+    if failed:
+        sys.exit(1)
+
+class AlgoSupervisor(object):
+    ''' spawn one detection process per video source and restart crashed workers '''
+    def __init__ (self, args, **kw) -> None:
+        self.args = args
+        self.poll_period = kw.pop('poll_period', 1)
+        self.restart_delay = kw.pop('restart_delay', 5)
+        self.ctx = mp.get_context('spawn')
+        self.quit_evt = self.ctx.Event()
+        ids = args.ids if args.ids else [args.id]
+        if len(ids) != len(args.source):
+            raise ValueError('Number of IDs {} does not match number of sources {}'.format(ids, args.source))
+        self.workers = {
+            id: {'source': src, 'proc': None, 'restarts': 0, 'next-start': 0}
+            for id, src in zip(ids, args.source)
+        }
+
+    def _spawn (self, id):
+        ''' start worker process for tester {id} '''
+        _worker = self.workers[id]
+        _args = argparse.Namespace(**vars(self.args))
+        _args.id = id
+        _worker['proc'] = self.ctx.Process(
+            target=run_algo_worker,
+            args=(_args, _worker['source'], _worker['restarts'], self.quit_evt),
+            name='algo-vid{}'.format(id),
+        )
+        _worker['proc'].start()
+        _worker['next-start'] = time.monotonic() + self.restart_delay
+        logging.debug('Worker vid{} started on {} (pid {})'.format(id, _worker['source'], _worker['proc'].pid))
+
+    def start (self):
+        ''' start all workers '''
+        for id in self.workers:
+            self._spawn(id)
+
+    def monitor (self):
+        ''' block and restart crashed workers until close() is called '''
+        while not self.quit_evt.wait(self.poll_period):
+            for id, _worker in self.workers.items():
+                if _worker['proc'].is_alive() or time.monotonic() < _worker['next-start']:
+                    continue
+                logging.error('Worker vid{} exited with code {}, restarting ...'.format(id, _worker['proc'].exitcode))
+                _worker['restarts'] += 1
+                self._spawn(id)
+
+    def close (self):
+        ''' stop all workers '''
+        self.quit_evt.set()
+        for id, _worker in self.workers.items():
+            _worker['proc'].join(5)
+            if _worker['proc'].is_alive():
+                logging.debug('Worker vid{} not terminating, killing ...'.format(id))
+                _worker['proc'].terminate()
 
 if __name__ == "__main__":
     scriptPath = pathlib.Path(__file__).parent.resolve()
@@ -148,8 +332,36 @@ if __name__ == "__main__":
         parser,
         id=1
     )
+    au.add_arg(parser, '--source', t=str, n='+', h='video source for detection, one per tester {D}', d=['/dev/video0'])
+    au.add_arg(parser, '--ids', t=str, n='+', h='tester ID for each source in supervisor mode {D}', d=None)
+    au.add_arg(parser, '--supervisor', a=True, h='run one detection process per source {D}')
+    au.add_arg(parser, '--status-period', t=int, h='period in seconds of status update {D}', d=5)
+    au.add_arg(parser, '--preview-period', t=int, h='period in seconds of JPEG preview snapshot, 0 to disable {D}', d=0)
+    au.add_arg(parser, '--preview-dir', t=str, h='directory for preview snapshots, Redis key tester.<id>.preview only if not set {D}', d=None)
+    au.add_arg(parser, '--confirm-popup', a=True, h='pop up also needs a blue popup in the HSV mask {D}')
+    au.add_arg(parser, '--backend', t=str, c=['auto', 'v4l2', 'file', 'synthetic'], h='capture backend {D}', d='auto')
+    au.add_arg(parser, '--width', t=int, h='capture width requested from V4L2 devices {D}', d=None)
+    au.add_arg(parser, '--height', t=int, h='capture height requested from V4L2 devices {D}', d=None)
+    au.add_arg(parser, '--fourcc', t=str, h='pixel format requested from V4L2 devices, e.g. MJPG or YUYV {D}', d=None)
+    au.add_arg(parser, '--capture-buffer', t=int, h='V4L2 driver buffer count {D}', d=None)
+    au.add_arg(parser, '--start-time', t=float, h='seconds into a video file where analysis starts {D}', d=0)
+    au.add_arg(parser, '--idle-fps', t=float, h='processed frames per second while waiting for a pop up, 0 for every frame {D}', d=0)
+    au.add_arg(parser, '--instrument', a=True, h='time detection stages and publish a summary with the status {D}')
+    au.add_arg(parser, '--engine', t=str, c=['frame', 'background', 'keyframe'], h='change detection against the previous frame, a running average background or the last idle frame without a significant change {D}', d='frame')
+    au.add_arg(parser, '--hash-skip', a=True, h='skip frames with the 16x16 cell levels of the last diffed frame while idle or alerted {D}')
+    au.add_arg(parser, '--log-rate', t=float, h='log records per second of each event after a burst of 5, 0 for no limit {D}', d=1)
     args = au.parse_args(parser)
 
+    if args.supervisor:
+        sup = AlgoSupervisor(args=args)
+        sup.start()
+        try:
+            sup.monitor()
+        except KeyboardInterrupt:
+            sup.close()
+        sys.exit(0)
+
+    listener = start_queue_logging(rate=args.log_rate)
     alw = AlgoWrapper(args=args)
     alw.start()
     
@@ -159,3 +371,4 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         alw.algo_close()
         alw.close()
+    stop_queue_logging(listener)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+analysis.py
+Helpers shared by the frame difference detectors
+'''
+import cv2
+import numpy as np
+
+# supported analysis resolutions relative to capture resolution
+ANALYSIS_SCALES = [1.0, 0.5, 0.25]
+
+# side of the change map tiles in capture pixels
+TILE_SIZE = 32
+# changes spanning at most this many tiles in both directions are cursor sized
+CURSOR_TILES = 2
+
+# weight of the newest frame in the running average of BackgroundPipeline
+BACKGROUND_ALPHA = 0.05
+# popup boxes kept out of the running average at the same time
+MAX_HELD_REGIONS = 8
+
+# side of the grid of cell levels of FrameHash
+HASH_SIZE = 16
+# strided samples per cell side averaged into a cell level
+HASH_SAMPLES = 8
+# cell level change of FrameHash that is a change, as fraction of the diff threshold:
+# the threshold crossed on 1 / 40 of a cell, a quarter of the minor change of a whole frame spread over 256 cells
+HASH_TOLERANCE = 1 / 40
+# frames skipped in a row before FrameHash lets a frame through to the diff
+HASH_MAX_SKIPS = 30
+
+
+def analysis_gray(frame, scale=1.0):
+    ''' convert BGR frame to grayscale at analysis resolution '''
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if scale == 1.0:
+        return gray
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def scale_area(area, scale):
+    ''' rescale an area given in capture pixels to analysis pixels '''
+    return area * scale * scale
+
+
+def large_regions(thresh, min_area, labels=None):
+    ''' return (detected, boxes) for connected changed regions of more than {min_area} pixels
+        boxes is an Nx4 array of x, y, w, h, {labels} is an optional int32 output buffer
+    '''
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, labels=labels, connectivity=8)
+    # label 0 is the unchanged background
+    _large = stats[1:, cv2.CC_STAT_AREA] > min_area
+    return bool(_large.any()), stats[1:, :4][_large]
+
+
+def to_display(thresh_diff, frame):
+    ''' convert thresholded diff to BGR at the size of {frame} for side by side display '''
+    thresh_diff_bgr = cv2.cvtColor(thresh_diff, cv2.COLOR_GRAY2BGR)
+    if thresh_diff_bgr.shape[:2] != frame.shape[:2]:
+        thresh_diff_bgr = cv2.resize(thresh_diff_bgr, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+    return thresh_diff_bgr
+
+
+class FrameHash(object):
+    ''' {size} x {size} grid of cell levels averaged from a strided view of the frame, the frame is never converted
+        a frame is unchanged if no cell level moved more than {threshold} * HASH_TOLERANCE from the last frame let through,
+        so a change crossing the diff threshold on a fraction of a cell is seen, whatever the brightness of the rest
+        at least every {max_skips} + 1 frame is let through
+        with a layout.ScreenLayout {roi}, only the rows between the bars are sampled so the clock does not change the levels
+    '''
+    def __init__(self, frame_shape, threshold, size=HASH_SIZE, roi=None, max_skips=HASH_MAX_SKIPS) -> None:
+        height, width = frame_shape[:2]
+        top_y, bottom_y = (roi.top_y, roi.bottom_y) if roi is not None else (0, height)
+        step_y = max((bottom_y - top_y) // (size * HASH_SAMPLES), 1)
+        step_x = max(width // (size * HASH_SAMPLES), 1)
+        self.rows = slice(top_y + step_y // 2, bottom_y, step_y)
+        self.cols = slice(step_x // 2, width, step_x)
+        self.size = size
+        self.tolerance = threshold * HASH_TOLERANCE
+        self.max_skips = max_skips
+        self.level = np.empty((size, size, frame_shape[2]), np.uint8)
+        self.ref_level = np.empty_like(self.level)
+        self.delta = np.empty_like(self.level)
+        self.primed = False
+        self.skips = 0
+        self.checks = 0
+        self.hits = 0
+        self.forced = 0
+
+    def update(self, frame):
+        ''' return True if {frame} can skip the diff, otherwise its levels become the reference '''
+        cv2.resize(frame[self.rows, self.cols], (self.size, self.size), dst=self.level, interpolation=cv2.INTER_AREA)
+        self.checks += 1
+        if self.primed:
+            cv2.absdiff(self.level, self.ref_level, dst=self.delta)
+            if self.delta.max() <= self.tolerance:
+                if self.skips < self.max_skips:
+                    self.skips += 1
+                    self.hits += 1
+                    return True
+                self.forced += 1
+        self.level, self.ref_level = self.ref_level, self.level
+        self.primed = True
+        self.skips = 0
+        return False
+
+    def get_status(self):
+        ''' return fraction of frames skipping the diff and the frames let through after {max_skips} skips '''
+        return {
+            'hash-hit-rate': round(self.hits / max(self.checks, 1), 4),
+            'hash-forced': self.forced,
+        }
+
+
+class DiffPipeline(object):
+    ''' grayscale frame difference on preallocated buffers
+        after construction, process() and advance() allocate no frame sized buffers
+        with a layout.ScreenLayout {roi}, only the rows between the bars are diffed and the logos are masked out
+        the change mask is summed per tile, later stages only look at the box around the dirty tiles
+    '''
+    def __init__(self, frame_shape, threshold, scale=1.0, roi=None) -> None:
+        height, width = frame_shape[:2]
+        self.frame_shape = (height, width)
+        self.threshold = threshold
+        self.scale = scale
+        self.roi = roi
+        self.top_y = 0
+        if roi is not None:
+            self.top_y = roi.top_y
+            height = roi.bottom_y - roi.top_y
+        self.rows = slice(self.top_y, self.top_y + height)
+        self.size = (int(round(width * scale)), int(round(height * scale)))
+
+        # full resolution gray is only needed as resize source
+        self.full_gray = None if scale == 1.0 else np.empty((height, width), np.uint8)
+        _shape = (self.size[1], self.size[0])
+        self.gray = np.empty(_shape, np.uint8)
+        self.prev_gray = np.empty(_shape, np.uint8)
+        self.diff = np.empty(_shape, np.uint8)
+        self.labels = np.empty(_shape, np.int32)
+
+        # change mask is a view of a buffer padded to whole tiles, padding stays 0
+        self.tile = max(4, int(round(TILE_SIZE * scale)))
+        self.tiles = (-(-_shape[0] // self.tile), -(-_shape[1] // self.tile))
+        self.padded = np.zeros((self.tiles[0] * self.tile, self.tiles[1] * self.tile), np.uint8)
+        self.thresh = self.padded[:_shape[0], :_shape[1]]
+        self.band_sums = np.empty((self.tiles[0], self.padded.shape[1]), np.int32)
+        self.tile_sums = np.empty(self.tiles, np.int32)
+        # box of the dirty tiles in analysis pixels (x, y, w, h), None if nothing changed
+        self.dirty_box = None
+        # cached exclusion mask, only rebuilt with the pipeline when the layout changes
+        self.mask = roi.roi_mask(self.size) if roi is not None else None
+        self.pixels = self.gray.size if self.mask is None else cv2.countNonZero(self.mask)
+
+        # frames reaching each stage of significant_change()
+        self.stage_counts = {'count': 0, 'bbox': 0, 'components': 0}
+        # changed frames by size of the dirty tile box
+        self.change_counts = {'cursor': 0, 'dialog': 0}
+        # boxes of the large regions found by the last significant_change(), capture coordinates, empty if it found none
+        self.no_boxes = np.empty((0, 4), np.int32)
+        self.regions = self.no_boxes
+        # same boxes in analysis coordinates
+        self.boxes = self.no_boxes
+
+    def _to_gray(self, frame, dst):
+        ''' convert BGR frame into {dst} at analysis resolution '''
+        frame = frame[self.rows]
+        if self.full_gray is None:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.full_gray)
+            cv2.resize(self.full_gray, self.size, dst=dst, interpolation=cv2.INTER_AREA)
+
+    def fits(self, frame):
+        ''' True if the buffers were set up at the resolution of {frame} '''
+        return frame.shape[:2] == self.frame_shape
+
+    def prime(self, frame):
+        ''' load the first frame as previous frame '''
+        self._to_gray(frame, self.prev_gray)
+
+    def process(self, frame):
+        ''' diff {frame} against the previous frame and return the changed pixel count
+            the binary change mask is left in self.thresh
+        '''
+        self._to_gray(frame, self.gray)
+        self._diff()
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.thresh)
+        if self.mask is not None:
+            cv2.bitwise_and(self.thresh, self.mask, dst=self.thresh)
+        self.stage_counts['count'] += 1
+        nonzero_pixels = self._sum_tiles()
+        if self.dirty_box is not None:
+            self.change_counts['cursor' if self.cursor_sized() else 'dialog'] += 1
+        return nonzero_pixels
+
+    def _diff(self):
+        ''' absolute difference of the current gray frame and the reference into self.diff '''
+        cv2.absdiff(self.gray, self.prev_gray, dst=self.diff)
+
+    def _sum_tiles(self):
+        ''' count changed pixels per tile, update the dirty tile box and return the total count '''
+        # sum tile rows of every band, then tile columns of every band
+        np.add.reduce(self.padded.reshape(self.tiles[0], self.tile, -1), axis=1, dtype=np.int32, out=self.band_sums)
+        np.add.reduce(self.band_sums.reshape(self.tiles[0], self.tiles[1], self.tile), axis=2, out=self.tile_sums)
+        self.tile_sums //= 255
+
+        _rows = np.flatnonzero(self.tile_sums.any(axis=1))
+        if not len(_rows):
+            self.dirty_box = None
+            return 0
+        _cols = np.flatnonzero(self.tile_sums.any(axis=0))
+        x, y = _cols[0] * self.tile, _rows[0] * self.tile
+        w = min((_cols[-1] + 1) * self.tile, self.thresh.shape[1]) - x
+        h = min((_rows[-1] + 1) * self.tile, self.thresh.shape[0]) - y
+        self.dirty_box = (int(x), int(y), int(w), int(h))
+        return int(self.tile_sums.sum())
+
+    def cursor_sized(self):
+        ''' True if the last change fits in a few tiles, like a mouse cursor or a caret, no contours needed '''
+        if self.dirty_box is None:
+            return False
+        _limit = CURSOR_TILES * self.tile
+        return self.dirty_box[2] <= _limit and self.dirty_box[3] <= _limit
+
+    def significant_change(self, nonzero_pixels, significant_change_threshold, min_area):
+        ''' True if enough pixels changed and one changed region is larger than {min_area}
+            cheap stages run first: pixel count, then box of the dirty tiles, then connected components inside that box
+        '''
+        self.boxes = self.regions = self.no_boxes
+        if nonzero_pixels <= significant_change_threshold or self.dirty_box is None:
+            return False
+        self.stage_counts['bbox'] += 1
+        # no region can be larger than the box around every dirty tile
+        x, y, w, h = self.dirty_box
+        if w * h <= min_area:
+            return False
+        self.stage_counts['components'] += 1
+        # labels buffer is reused as a contiguous w x h image
+        detected, boxes = large_regions(self.thresh[y:y + h, x:x + w], min_area, labels=self.labels.reshape(-1)[:w * h].reshape(h, w))
+        boxes[:, 0] += x
+        boxes[:, 1] += y
+        self.boxes = boxes
+        self.regions = (boxes / self.scale).astype(np.int32) if self.scale != 1.0 else boxes.copy()
+        self.regions[:, 1] += self.top_y
+        return detected
+
+    def get_status(self):
+        ''' return fraction of processed frames reaching each detection stage '''
+        _frames = max(self.stage_counts['count'], 1)
+        return {
+            'cascade': {k: round(v / _frames, 4) for k, v in self.stage_counts.items()},
+            'changes': dict(self.change_counts),
+        }
+
+    def advance(self):
+        ''' current frame becomes previous frame, buffers are swapped by reference '''
+        self.gray, self.prev_gray = self.prev_gray, self.gray
+
+
+class BackgroundPipeline(DiffPipeline):
+    ''' DiffPipeline where a pixel only changes if it differs from the previous frame and from a running average of the frames
+        the background is an exponential average with weight {alpha} on a preallocated float buffer
+        changes back to the background, like a closed popup or a blinking item, are no change, and neither are the
+        slow fades and the tails of past changes that differ from the background but not from the previous frame
+
+        boxes of the regions found by significant_change() are held out of the average, the background keeps the screen
+        under a popup while it is open and closing it is no change, a held box is released once it matches the background
+        release_reference() diffs consecutive frames like DiffPipeline, hold_reference() goes back to the background
+    '''
+    def __init__(self, frame_shape, threshold, scale=1.0, roi=None, alpha=BACKGROUND_ALPHA) -> None:
+        DiffPipeline.__init__(self, frame_shape, threshold, scale, roi)
+        self.alpha = alpha
+        self.background = np.empty(self.gray.shape, np.float32)
+        self.last_gray = np.empty(self.gray.shape, np.uint8)
+        self.frame_diff = np.empty(self.gray.shape, np.uint8)
+        # 0 over the held boxes, only used while a box is held
+        self.update_mask = np.empty(self.gray.shape, np.uint8)
+        self.held = []
+        self.held_count = 0
+        self.consecutive = False
+
+    def prime(self, frame):
+        ''' load the first frame as background '''
+        DiffPipeline.prime(self, frame)
+        self.background[:] = self.prev_gray
+        self.last_gray[:] = self.prev_gray
+        self.held = []
+
+    def hold_reference(self):
+        ''' diff against the background and the previous frame from the next frame on '''
+        self.consecutive = False
+
+    def release_reference(self):
+        ''' diff consecutive frames only from the next frame on, the background is still updated '''
+        self.consecutive = True
+
+    def _diff(self):
+        ''' smaller of the differences to the background and to the previous frame '''
+        if self.consecutive:
+            cv2.absdiff(self.gray, self.last_gray, dst=self.diff)
+            return
+        DiffPipeline._diff(self)
+        # popup closed, the screen under it is back
+        self.held = [(x, y, w, h) for x, y, w, h in self.held
+            if np.count_nonzero(self.diff[y:y + h, x:x + w] > self.threshold) > 0.01 * w * h]
+        cv2.absdiff(self.gray, self.last_gray, dst=self.frame_diff)
+        cv2.min(self.diff, self.frame_diff, dst=self.diff)
+
+    def significant_change(self, nonzero_pixels, significant_change_threshold, min_area):
+        ''' DiffPipeline.significant_change(), the large regions found by this call are held out of the background '''
+        detected = DiffPipeline.significant_change(self, nonzero_pixels, significant_change_threshold, min_area)
+        for x, y, w, h in self.boxes.tolist():
+            if not any(hx <= x and hy <= y and x + w <= hx + hw and y + h <= hy + hh for hx, hy, hw, hh in self.held):
+                self.held.append((x, y, w, h))
+                self.held_count += 1
+        del self.held[:-MAX_HELD_REGIONS]
+        return detected
+
+    def advance(self):
+        ''' blend current frame into the background outside held boxes, previous frame buffer holds the background as 8 bit '''
+        if self.held:
+            self.update_mask.fill(255)
+            for x, y, w, h in self.held:
+                self.update_mask[y:y + h, x:x + w] = 0
+            cv2.accumulateWeighted(self.gray, self.background, self.alpha, mask=self.update_mask)
+        else:
+            cv2.accumulateWeighted(self.gray, self.background, self.alpha)
+        cv2.convertScaleAbs(self.background, dst=self.prev_gray)
+        self.gray, self.last_gray = self.last_gray, self.gray
+
+    def get_status(self):
+        ''' pipeline status with the number of regions held out of the background '''
+        _status = DiffPipeline.get_status(self)
+        _status['held-regions'] = self.held_count
+        return _status
+
+
+class KeyframePipeline(DiffPipeline):
+    ''' DiffPipeline keeping its reference frame while a significant change is present, as frame_difference.frame_difference2
+        that only replaces prev_frame_gray on frames without a significant change
+        hold_reference() makes the current frame the reference at advance() and keeps references over significant changes,
+        release_reference() goes back to consecutive frames
+    '''
+    def __init__(self, frame_shape, threshold, scale=1.0, roi=None) -> None:
+        DiffPipeline.__init__(self, frame_shape, threshold, scale, roi)
+        # the primed frame is the first reference
+        self.hold = True
+        self.refresh = False
+        # last significant_change() result of the current frame
+        self.changed = False
+        self.keyframes = 1
+        self.held_frames = 0
+
+    def hold_reference(self):
+        ''' take the current frame as reference and keep references over significant changes '''
+        self.hold = True
+        self.refresh = True
+
+    def release_reference(self):
+        ''' diff consecutive frames again from the next frame on '''
+        self.hold = False
+
+    def significant_change(self, nonzero_pixels, significant_change_threshold, min_area):
+        ''' DiffPipeline.significant_change(), a significant change keeps the reference at advance() '''
+        self.changed = DiffPipeline.significant_change(self, nonzero_pixels, significant_change_threshold, min_area)
+        return self.changed
+
+    def advance(self):
+        ''' current frame becomes the reference unless a reference is held over a significant change '''
+        _changed, self.changed = self.changed, False
+        if self.refresh:
+            self.keyframes += 1
+            self.refresh = False
+        elif self.hold and _changed:
+            self.held_frames += 1
+            return
+        DiffPipeline.advance(self)
+
+    def get_status(self):
+        ''' pipeline status with the number of reference frames taken '''
+        _status = DiffPipeline.get_status(self)
+        _status['keyframes'] = self.keyframes
+        _status['held-frames'] = self.held_frames
+        return _status
+
+
+# change detection engines selectable by name
+DIFF_ENGINES = {
+    'frame': DiffPipeline,
+    'background': BackgroundPipeline,
+    'keyframe': KeyframePipeline,
+}
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+benchmark.py
+Accuracy and speed reports for the detection pipeline on recorded tester videos
+
+    python3 benchmark.py scale video1.mp4 video2.mp4 --scales 1 0.5 0.25
+    python3 benchmark.py components --width 1920 --height 1080 --density 0.02
+    python3 benchmark.py pipeline video1.mp4 --synthetic 1920x1080 1280x720 --json report.json
+    python3 benchmark.py engines --scenes fade tester --type 2
+'''
+import time
+import json
+import logging
+import pathlib
+import tempfile
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+
+from analysis import ANALYSIS_SCALES, DIFF_ENGINES, analysis_gray, scale_area, large_regions
+from capture import open_capture
+
+
+class ScaleRun(object):
+    ''' frame difference tests of final_algo at one analysis scale '''
+    def __init__(self, scale, threshold, min_area) -> None:
+        self.scale = scale
+        self.threshold = threshold
+        self.min_area = scale_area(min_area, scale)
+        self.prev_frame_gray = None
+        self.elapsed = 0.0
+        self.popups = set()
+        self.interactions = set()
+
+    def process(self, idx, frame):
+        ''' run popup and interaction tests on frame {idx} '''
+        _start = time.perf_counter()
+        current_frame_gray = analysis_gray(frame, self.scale)
+        if self.prev_frame_gray is not None:
+            frame_diff = cv2.absdiff(current_frame_gray, self.prev_frame_gray)
+            _, thresh_diff = cv2.threshold(frame_diff, self.threshold, 255, cv2.THRESH_BINARY)
+
+            nonzero_pixels = cv2.countNonZero(thresh_diff)
+            significant_change_threshold = current_frame_gray.size * 0.001
+            minor_change_threshold = current_frame_gray.size * 0.0001
+            mouse_change_threshold = current_frame_gray.size * 0.0005
+
+            significant_change_detected, _ = large_regions(thresh_diff, self.min_area)
+
+            if nonzero_pixels > significant_change_threshold and significant_change_detected:
+                self.popups.add(idx)
+            if minor_change_threshold < nonzero_pixels < mouse_change_threshold:
+                self.interactions.add(idx)
+        self.prev_frame_gray = current_frame_gray
+        self.elapsed += time.perf_counter() - _start
+
+
+def _agreement(ref, test):
+    ''' return (recall, precision) of frame set {test} against {ref} '''
+    _hit = len(ref & test)
+    recall = _hit / len(ref) if ref else 1.0
+    precision = _hit / len(test) if test else 1.0
+    return round(recall, 4), round(precision, 4)
+
+
+def scale_report(video_path, scales=ANALYSIS_SCALES, threshold=150, min_area=500, max_frames=None):
+    ''' decode {video_path} once and compare every scale against full resolution '''
+    scales = sorted(set([1.0, *scales]), reverse=True)
+    runs = [ScaleRun(s, threshold, min_area) for s in scales]
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logging.error('Unable to open video {}'.format(video_path))
+        return []
+    frames = 0
+    while max_frames is None or frames < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        for run in runs:
+            run.process(frames, frame)
+        frames += 1
+    cap.release()
+
+    ref = runs[0]
+    report = []
+    for run in runs:
+        _ms = run.elapsed * 1000 / frames if frames else 0
+        report.append({
+            'video': str(video_path),
+            'scale': run.scale,
+            'frames': frames,
+            'ms-per-frame': round(_ms, 3),
+            'speedup': round(ref.elapsed / run.elapsed, 2) if run.elapsed else None,
+            'popup-frames': len(run.popups),
+            'popup-recall-precision': _agreement(ref.popups, run.popups),
+            'interaction-frames': len(run.interactions),
+            'interaction-recall-precision': _agreement(ref.interactions, run.interactions),
+        })
+    return report
+
+
+def print_scale_report(report):
+    ''' print scale report as a table '''
+    print('{:>6} {:>8} {:>12} {:>8} {:>8} {:>16} {:>8} {:>16}'.format(
+        'scale', 'frames', 'ms/frame', 'speedup', 'popups', 'popup r/p', 'interact', 'interact r/p'))
+    for row in report:
+        print('{:>6} {:>8} {:>12} {:>8} {:>8} {:>16} {:>8} {:>16}'.format(
+            row['scale'], row['frames'], row['ms-per-frame'], row['speedup'],
+            row['popup-frames'], '{}/{}'.format(*row['popup-recall-precision']),
+            row['interaction-frames'], '{}/{}'.format(*row['interaction-recall-precision']),
+        ))
+
+
+def noisy_mask(width, height, density, popup=False, seed=0):
+    ''' binary change mask of scattered glyph sized blobs, like a scrolling log, with optional dialog '''
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), np.uint8)
+    _blobs = int(width * height * density / 12)
+    xs = rng.integers(0, width - 3, _blobs)
+    ys = rng.integers(0, height - 4, _blobs)
+    for dx in range(3):
+        for dy in range(4):
+            # sparse 3x4 glyphs, mostly unconnected
+            _keep = rng.random(_blobs) < 0.5
+            mask[ys[_keep] + dy, xs[_keep] + dx] = 255
+    if popup:
+        mask[height // 3: height // 3 + height // 5, width // 3: width // 3 + width // 4] = 255
+    return mask
+
+
+def components_report(width=1920, height=1080, density=0.02, min_area=500, repeat=20):
+    ''' per-frame time of contour loop vs connected components on noisy masks '''
+    report = []
+    for popup in [False, True]:
+        mask = noisy_mask(width, height, density, popup)
+        labels = np.empty(mask.shape, np.int32)
+        _times = {'contours': 0.0, 'components': 0.0}
+        for _ in range(repeat):
+            _start = time.perf_counter()
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            by_contours = any(cv2.contourArea(contour) > min_area for contour in contours)
+            _times['contours'] += time.perf_counter() - _start
+
+            _start = time.perf_counter()
+            by_components, _ = large_regions(mask, min_area, labels=labels)
+            _times['components'] += time.perf_counter() - _start
+        report.append({
+            'resolution': '{}x{}'.format(width, height),
+            'popup': popup,
+            'regions': len(contours),
+            'contours-ms': round(_times['contours'] * 1000 / repeat, 3),
+            'components-ms': round(_times['components'] * 1000 / repeat, 3),
+            'agree': by_contours == by_components,
+        })
+    return report
+
+
+class TimedCapture(object):
+    ''' capture proxy splitting every frame into decode time and processing time
+        processing of a frame lasts from the return of its read() to the next read()
+    '''
+    def __init__(self, cap) -> None:
+        self.cap = cap
+        self.decode = []
+        self.process = []
+        self.shape = None
+        self._returned = None
+
+    def read(self, image=None):
+        _start = time.perf_counter()
+        if self._returned is not None:
+            self.process.append(_start - self._returned)
+        ret, frame = self.cap.read(image)
+        self._returned = time.perf_counter()
+        if ret:
+            self.decode.append(self._returned - _start)
+            self.shape = frame.shape
+        return ret, frame
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+    def latencies(self):
+        ''' per-frame decode plus processing time in seconds '''
+        _n = min(len(self.decode), len(self.process))
+        return np.array(self.decode[:_n]) + np.array(self.process[:_n])
+
+
+class StageTimer(object):
+    ''' accumulate seconds per stage '''
+    def __init__(self) -> None:
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+    def wrap(self, stage, func):
+        ''' return {func} timed as {stage} '''
+        def _timed(*args, **kw):
+            _start = time.perf_counter()
+            try:
+                return func(*args, **kw)
+            finally:
+                self.add(stage, time.perf_counter() - _start)
+        return _timed
+
+
+class TimedPipeline(object):
+    ''' run the steps of analysis.DiffPipeline.process() on the wrapped pipeline, timing each of them '''
+    def __init__(self, pipeline, timer) -> None:
+        self.pipeline = pipeline
+        self.timer = timer
+        self.significant_change = timer.wrap('components', pipeline.significant_change)
+
+    def process(self, frame):
+        p, t = self.pipeline, self.timer
+        _t0 = time.perf_counter()
+        p._to_gray(frame, p.gray)
+        _t1 = time.perf_counter()
+        p._diff()
+        _t2 = time.perf_counter()
+        cv2.threshold(p.diff, p.threshold, 255, cv2.THRESH_BINARY, dst=p.thresh)
+        if p.mask is not None:
+            cv2.bitwise_and(p.thresh, p.mask, dst=p.thresh)
+        _t3 = time.perf_counter()
+        p.stage_counts['count'] += 1
+        nonzero_pixels = p._sum_tiles()
+        if p.dirty_box is not None:
+            p.change_counts['cursor' if p.cursor_sized() else 'dialog'] += 1
+        _t4 = time.perf_counter()
+        t.add('cvtColor', _t1 - _t0)
+        t.add('absdiff', _t2 - _t1)
+        t.add('threshold', _t3 - _t2)
+        t.add('tiles', _t4 - _t3)
+        return nonzero_pixels
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+
+class NullPublisher(object):
+    ''' stands in for the redis connection '''
+    def publish(self, ch, msg):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+def _bench_final(video, timer, **kw):
+    ''' drive final_algo.TesterDetection like replay.py and time its stages
+        publish is the json encoding of results, there is no redis round trip
+    '''
+    import final_algo
+
+    algo = final_algo.TesterDetection(video, NullPublisher(), 'benchmark', clock='capture', **kw)
+    algo.load_configuration()
+    algo.classifier.classify = timer.wrap('hsv', algo.classifier.classify)
+    _build = algo._build_pipeline
+
+    def _build_timed(frame):
+        _build(frame)
+        algo.pipeline = TimedPipeline(algo.pipeline, timer)
+    algo._build_pipeline = _build_timed
+
+    cap = TimedCapture(open_capture(video, 'file'))
+    ret, frame = cap.read()
+    if not ret:
+        return cap
+    algo.detect_layout(frame)
+    algo.start_analysis(frame)
+    _state = 0.0
+    _json2str = final_algo.json2str
+    final_algo.json2str = timer.wrap('publish', _json2str)
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            _start = time.perf_counter()
+            algo.process_frame(frame, algo.clock.stamp(cap))
+            _state += time.perf_counter() - _start
+    finally:
+        final_algo.json2str = _json2str
+    cap.release()
+    # state machine is what process_frame spends outside the timed stages
+    timer.add('state-machine', _state - sum(v for k, v in timer.totals.items() if k != 'decode'))
+    return cap
+
+
+def _bench_popup(video, timer, **kw):
+    ''' drive popup_detection.mask_and_detect_popups headless '''
+    from popup_detection import mask_and_detect_popups
+
+    cap = TimedCapture(open_capture(video, 'file'))
+    with tempfile.TemporaryDirectory() as output_dir:
+        mask_and_detect_popups(cap, output_dir, display=False)
+    # the detection loop is not split into stages
+    timer.add('process', sum(cap.process))
+    return cap
+
+
+def _bench_initial(video, timer, **kw):
+    ''' drive initial_algo.detection headless with the type 1 thresholds '''
+    from initial_algo import detection
+
+    det = detection(video, None, None, displayVid=False, **kw)
+    det.frame_threshold = 5
+    det.threshold = 150
+    det.cap = cap = TimedCapture(open_capture(video, 'file'))
+    det.fps = cap.get(cv2.CAP_PROP_FPS)
+    det.fps_stop = int(det.fps * det.frame_threshold)
+    det.process_frames()
+    timer.add('process', sum(cap.process))
+    return cap
+
+
+DETECTORS = {
+    'final': _bench_final,
+    'popup': _bench_popup,
+    'initial': _bench_initial,
+}
+
+
+def pipeline_report(video, detectors=list(DETECTORS), analysisScale=1.0, diffEngine='frame'):
+    ''' run every detector over {video}, return fps, p50/p99 frame latency and per-stage ms per frame
+        {diffEngine} only applies to the final detector
+    '''
+    report = []
+    for name in detectors:
+        timer = StageTimer()
+        _kw = {'analysisScale': analysisScale} if name != 'popup' else {}
+        if name == 'final':
+            _kw['diffEngine'] = diffEngine
+        _start = time.perf_counter()
+        cap = DETECTORS[name](str(video), timer, **_kw)
+        _elapsed = time.perf_counter() - _start
+
+        frames = len(cap.decode)
+        if not frames:
+            logging.error('Unable to read video {}'.format(video))
+            continue
+        latencies = cap.latencies() * 1000
+        timer.add('decode', sum(cap.decode))
+        report.append({
+            'detector': name,
+            'video': str(video),
+            'resolution': '{}x{}'.format(cap.shape[1], cap.shape[0]),
+            'scale': analysisScale,
+            'engine': diffEngine if name == 'final' else None,
+            'frames': frames,
+            'fps': round(frames / _elapsed, 2) if _elapsed else None,
+            'p50-ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+            'p99-ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None,
+            'stages-ms': {k: round(v * 1000 / max(frames, 1), 3) for k, v in timer.totals.items()},
+        })
+    return report
+
+
+class StageCounter(NullPublisher):
+    ''' stands in for the redis connection and counts the published stages '''
+    def __init__(self) -> None:
+        self.stages = {}
+
+    def publish(self, ch, msg):
+        _stage = json.loads(msg).get('stage')
+        self.stages[_stage] = self.stages.get(_stage, 0) + 1
+
+
+ENGINE_SCENES = ['fade', 'tester']
+
+
+def scene_frames(scene, screen, fade_step=4, fade_depth=120):
+    ''' yield the frames of {scene} rendered from {screen}
+        fade: the screen without popups going darker and back by {fade_step} gray levels per frame
+        tester: the screen with its scrolling log, cursor moves and popups
+    '''
+    if scene == 'fade':
+        screen.popups = []
+    for index in range(int(screen.duration * screen.fps)):
+        frame = screen.render(index)
+        if scene == 'fade':
+            _level = fade_step * index % (2 * fade_depth)
+            _level = min(_level, 2 * fade_depth - _level)
+            cv2.subtract(frame, (_level, _level, _level, 0), dst=frame)
+        yield index / screen.fps, frame
+
+
+def engines_report(scenes=ENGINE_SCENES, engines=list(DIFF_ENGINES), detectionType=2, width=1280, height=720, duration=30, seed=0):
+    ''' run the final detector with every diff engine over synthetic scenes rendered in memory
+        return the published stages, the idle frames and the frames reaching the region and HSV stages, alerts are reset at once
+    '''
+    from final_algo import TesterDetection
+    from synthetic import TesterScreen
+
+    report = []
+    for scene in scenes:
+        for engine in engines:
+            counter = StageCounter()
+            algo = TesterDetection(scene, counter, scene, detectionType=detectionType, clock='capture', diffEngine=engine)
+            algo.load_configuration()
+            _classify = algo.classifier.classify
+            _classified = [0]
+
+            def _counted(*args, **kw):
+                _classified[0] += 1
+                return _classify(*args, **kw)
+            algo.classifier.classify = _counted
+
+            frames = scene_frames(scene, TesterScreen(width, height, duration=duration, seed=seed))
+            _, frame = next(frames)
+            algo.detect_layout(frame)
+            algo.start_analysis(frame)
+            _idle = 0
+            _start = time.perf_counter()
+            for now, frame in frames:
+                # region tests only run on idle frames, an engine publishing fewer popUps has more of them
+                _idle += algo.stage == 'idle'
+                algo.process_frame(frame, now)
+                if algo.stage == 'alert':
+                    algo.set_alert_stage('alert-reset', status=True)
+            _elapsed = time.perf_counter() - _start
+
+            report.append({
+                'scene': scene,
+                'engine': engine,
+                'type': detectionType,
+                'frames': algo.frame_count,
+                'idle': _idle,
+                'popUps': counter.stages.get('popUp', 0),
+                'alerts': counter.stages.get('alert', 0),
+                'bbox': algo.pipeline.stage_counts['bbox'],
+                'components': algo.pipeline.stage_counts['components'],
+                'classify': _classified[0],
+                'ms-per-frame': round(_elapsed * 1000 / max(algo.frame_count, 1), 3),
+            })
+    return report
+
+
+def print_engines_report(report):
+    ''' print engines report as a table '''
+    _columns = ['scene', 'engine', 'frames', 'idle', 'popUps', 'alerts', 'bbox', 'components', 'classify', 'ms-per-frame']
+    print(' '.join('{:>12}'.format(c) for c in _columns))
+    for row in report:
+        print(' '.join('{:>12}'.format(row[c]) for c in _columns))
+
+
+def synthetic_videos(resolutions, workdir, duration=30, seed=0):
+    ''' render one synthetic video per WxH resolution into {workdir}, reusing existing files '''
+    from synthetic import write_video
+
+    pathlib.Path(workdir).mkdir(parents=True, exist_ok=True)
+    videos = []
+    for resolution in resolutions:
+        width, height = (int(v) for v in resolution.lower().split('x'))
+        path = pathlib.Path(workdir) / 'synthetic_{}_{}s_{}.avi'.format(resolution, duration, seed)
+        if not path.exists():
+            write_video(path, width=width, height=height, duration=duration, seed=seed)
+        videos.append(path)
+    return videos
+
+
+def print_pipeline_report(report):
+    ''' print pipeline report as a table with one stage breakdown line per row '''
+    print('{:>8} {:>10} {:>7} {:>8} {:>8} {:>8}'.format('detector', 'resolution', 'frames', 'fps', 'p50 ms', 'p99 ms'))
+    for row in report:
+        print('{:>8} {:>10} {:>7} {:>8} {:>8} {:>8}'.format(
+            row['detector'], row['resolution'], row['frames'], row['fps'], row['p50-ms'], row['p99-ms']))
+        print('         ' + ', '.join('{} {}'.format(k, v) for k, v in row['stages-ms'].items()))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Tester detection benchmark')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('scale', help='accuracy vs speed of analysis resolutions')
+    p.add_argument('videos', type=str, nargs='+')
+    p.add_argument('--scales', type=float, nargs='+', default=ANALYSIS_SCALES)
+    p.add_argument('--threshold', type=int, default=150)
+    p.add_argument('--min-area', type=int, default=500)
+    p.add_argument('--max-frames', type=int, default=None)
+    p.add_argument('--json', type=str, default=None, help='save report to json file')
+
+    p = sub.add_parser('components', help='contour loop vs connected components on noisy frames')
+    p.add_argument('--width', type=int, default=1920)
+    p.add_argument('--height', type=int, default=1080)
+    p.add_argument('--density', type=float, default=0.02, help='fraction of changed pixels')
+    p.add_argument('--min-area', type=int, default=500)
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--json', type=str, default=None, help='save report to json file')
+
+    p = sub.add_parser('pipeline', help='throughput, frame latency and stage breakdown of the detectors')
+    p.add_argument('videos', type=str, nargs='*', help='recorded videos')
+    p.add_argument('--synthetic', type=str, nargs='*', default=[], help='WxH resolutions of synthetic videos to add')
+    p.add_argument('--duration', type=float, default=30, help='seconds of synthetic video')
+    p.add_argument('--workdir', type=str, default=None, help='directory keeping synthetic videos, temporary if not set')
+    p.add_argument('--detectors', type=str, nargs='+', default=list(DETECTORS), choices=list(DETECTORS))
+    p.add_argument('--scale', type=float, default=1.0, help='analysis scale of final and initial detectors')
+    p.add_argument('--engine', type=str, default='frame', choices=list(DIFF_ENGINES), help='change detection engine of the final detector')
+    p.add_argument('--json', type=str, default=None, help='save report to json file')
+
+    p = sub.add_parser('engines', help='published popUps and downstream work of the diff engines on synthetic scenes')
+    p.add_argument('--scenes', type=str, nargs='+', default=ENGINE_SCENES, choices=ENGINE_SCENES)
+    p.add_argument('--engines', type=str, nargs='+', default=list(DIFF_ENGINES), choices=list(DIFF_ENGINES))
+    p.add_argument('--type', type=int, default=2, help='detection type setting the threshold')
+    p.add_argument('--width', type=int, default=1280)
+    p.add_argument('--height', type=int, default=720)
+    p.add_argument('--duration', type=float, default=30, help='seconds of every scene')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--json', type=str, default=None, help='save report to json file')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'scale':
+        results = []
+        for video in args.videos:
+            print(video)
+            report = scale_report(video, args.scales, args.threshold, args.min_area, args.max_frames)
+            print_scale_report(report)
+            results.extend(report)
+    elif args.command == 'components':
+        results = components_report(args.width, args.height, args.density, args.min_area, args.repeat)
+        for row in results:
+            print(row)
+    elif args.command == 'pipeline':
+        with tempfile.TemporaryDirectory() as _tmp:
+            videos = args.videos + synthetic_videos(args.synthetic, args.workdir or _tmp, args.duration)
+            results = []
+            for video in videos:
+                results.extend(pipeline_report(video, args.detectors, args.scale, args.engine))
+        print_pipeline_report(results)
+    elif args.command == 'engines':
+        results = engines_report(args.scenes, args.engines, args.type, args.width, args.height, args.duration, args.seed)
+        print_engines_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+capture.py
+Video capture with separate grab and decode steps
+
+grab() only moves to the next frame (dequeue a device buffer or demux a
+packet), retrieve() decodes it. Frames that are skipped or seeked over
+are only grabbed, and the time spent in both steps is reported
+
+Sources are opened by backend: V4L2 devices, video files or a synthetic
+tester screen for tests without hardware
+'''
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+
+from synthetic import TesterScreen
+
+
+class Capture(object):
+    ''' wrap an opened cv2.VideoCapture and time grab and retrieve separately
+        provides read(), grab(), retrieve(), get() and set() like cv2.VideoCapture
+    '''
+    def __init__(self, cap, live=True) -> None:
+        self.cap = cap
+        self.live = live
+        self.grabbed = 0
+        self.retrieved = 0
+        self.grab_time = 0.0
+        self.decode_time = 0.0
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def grab(self):
+        ''' move to the next frame without decoding it '''
+        _start = time.perf_counter()
+        ret = self.cap.grab()
+        self.grab_time += time.perf_counter() - _start
+        if ret:
+            self.grabbed += 1
+        return ret
+
+    def retrieve(self, image=None):
+        ''' decode the last grabbed frame into {image} when given '''
+        _start = time.perf_counter()
+        ret, frame = self.cap.retrieve(image)
+        self.decode_time += time.perf_counter() - _start
+        if ret:
+            self.retrieved += 1
+        return ret, frame
+
+    def read(self, image=None):
+        ''' grab and decode the next frame '''
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def skip(self, frames):
+        ''' grab {frames} frames without decoding, return the number of frames skipped '''
+        for _skipped in range(frames):
+            if not self.grab():
+                return _skipped
+        return frames
+
+    def seek(self, seconds):
+        ''' move a file source {seconds} from its start, live sources cannot seek
+            when the backend cannot set the position, frames are grabbed up to it
+        '''
+        if self.live:
+            logging.debug('Live source cannot seek to {}s, ignored'.format(seconds))
+            return False
+        start_frame = int(self.cap.get(cv2.CAP_PROP_FPS) * seconds)
+        if self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame):
+            return True
+        logging.debug('Backend cannot seek, grabbing {} frames'.format(start_frame))
+        return self.skip(start_frame) == start_frame
+
+    def release(self):
+        self.cap.release()
+
+    def get_status(self):
+        ''' return mean grab and decode time per frame in ms '''
+        return {
+            'grab-ms': round(self.grab_time * 1000 / max(self.grabbed, 1), 3),
+            'decode-ms': round(self.decode_time * 1000 / max(self.retrieved, 1), 3),
+            'decoded': self.retrieved,
+        }
+
+
+class SyntheticCapture(object):
+    ''' cv2.VideoCapture look-alike rendering frames instead of reading them
+        {render} is called with the frame index and returns a BGR frame
+        stops after {frames} frames, never if None
+    '''
+    def __init__(self, render, width=1920, height=1080, fps=30, frames=None) -> None:
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames = frames
+        self.render = render
+        self.index = -1
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        if not self.opened or (self.frames is not None and self.index + 1 >= self.frames):
+            return False
+        self.index += 1
+        return True
+
+    def retrieve(self, image=None):
+        if self.index < 0:
+            return False, None
+        frame = self.render(self.index)
+        if image is None or image.shape != frame.shape:
+            return True, frame.copy()
+        np.copyto(image, frame)
+        return True, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop):
+        return {
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv2.CAP_PROP_POS_FRAMES: self.index + 1,
+            cv2.CAP_PROP_POS_MSEC: max(self.index, 0) * 1000 / self.fps,
+            cv2.CAP_PROP_FRAME_COUNT: self.frames if self.frames is not None else -1,
+        }.get(prop, 0)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.index = int(value) - 1
+            return True
+        return False
+
+    def release(self):
+        self.opened = False
+
+
+def open_v4l2(source, width=None, height=None, fourcc=None, buffer_size=None, **kw):
+    ''' open V4L2 device {source} (path or index) with optional resolution, pixel format such as MJPG and buffer count '''
+    cap = cv2.VideoCapture(int(source) if str(source).isdigit() else source, cv2.CAP_V4L2)
+    # pixel format first, the driver picks the resolutions it offers for that format
+    if fourcc:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    if width:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    if height:
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if buffer_size:
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+    return Capture(cap, live=True)
+
+
+def open_file(source, **kw):
+    ''' open video file {source} '''
+    return Capture(cv2.VideoCapture(str(source)), live=False)
+
+
+def open_synthetic(source=None, width=None, height=None, fps=None, frames=None, render=None, seed=0, **kw):
+    ''' open a synthetic source, {source} is ignored
+        frames come from {render} or from a synthetic.TesterScreen drawn from {seed}, one hour long if {frames} is None
+    '''
+    width, height, fps = width or 1920, height or 1080, fps or 30
+    if render is None:
+        render = TesterScreen(width, height, fps, duration=frames / fps if frames else 3600, seed=seed).render
+    cap = SyntheticCapture(render, width, height, fps, frames=frames)
+    return Capture(cap, live=False)
+
+
+CAPTURE_BACKENDS = {
+    'v4l2': open_v4l2,
+    'file': open_file,
+    'synthetic': open_synthetic,
+}
+# backends delivering frames in real time, other backends deliver as fast as they are read
+LIVE_BACKENDS = ['v4l2']
+
+
+def resolve_backend(source, backend='auto'):
+    ''' return backend name, 'auto' picks file for existing files and v4l2 otherwise '''
+    if backend == 'auto':
+        backend = 'file' if os.path.isfile(str(source)) else 'v4l2'
+    if backend not in CAPTURE_BACKENDS:
+        raise ValueError('Unknown capture backend {}, expected one of {}'.format(backend, ['auto', *CAPTURE_BACKENDS]))
+    return backend
+
+
+def open_capture(source, backend='auto', **options):
+    ''' open {source} with {backend}, options are passed to the backend (width, height, fourcc, buffer_size, fps) '''
+    backend = resolve_backend(source, backend)
+    cap = CAPTURE_BACKENDS[backend](source, **options)
+    logging.debug('Opened {} with {} backend, {}'.format(source, backend, 'ok' if cap.isOpened() else 'failed'))
+    return cap
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+clock.py
+Time sources for frame timestamps
+
+Detection timing (pre-alert window) is measured between frame timestamps
+so that replaying a file faster than real time gives the same decisions
+as live capture
+'''
+import time
+
+import cv2
+
+
+class MonotonicClock(object):
+    ''' frame time is the arrival time on the monotonic clock '''
+    name = 'monotonic'
+
+    def stamp(self, cap):
+        ''' return timestamp in seconds of the frame just read from {cap} '''
+        return time.monotonic()
+
+
+class CaptureClock(object):
+    ''' frame time is the capture position reported by the backend (CAP_PROP_POS_MSEC) '''
+    name = 'capture'
+
+    def stamp(self, cap):
+        ''' return timestamp in seconds of the frame just read from {cap} '''
+        return cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+
+CLOCKS = {
+    'monotonic': MonotonicClock,
+    'capture': CaptureClock,
+}
+
+
+def get_clock(name, live):
+    ''' return clock instance by {name}
+        'auto' uses the monotonic clock for {live} sources and capture timestamps for files and synthetic sources
+    '''
+    if name == 'auto':
+        name = 'monotonic' if live else 'capture'
+    if name not in CLOCKS:
+        raise ValueError('Unknown clock {}, expected one of {}'.format(name, ['auto', *CLOCKS]))
+    return CLOCKS[name]()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+eventlog.py
+Structured, rate limited logging that never blocks the detection loop
+
+    log_event(logger, logging.INFO, 'stage', stage='preAlert', time=12.3)
+
+Events are logged as "<event> <json fields>" with the event name kept on
+the record. start_queue_logging() moves the root handlers behind a queue
+served by a listener thread, so the frame loop only pays for a put on
+the queue. Records over the rate of their event or call site are dropped
+before they are queued, the next record that passes reports how many were
+dropped. Warnings and errors are never dropped
+'''
+import queue
+import logging
+import logging.handlers
+import time
+import pathlib
+import sys
+
+scriptPath = pathlib.Path(__file__).parent.resolve()
+sys.path.append(str(scriptPath.parent / 'common'))
+from jsonutils import json2str
+
+
+def log_event(logger, level, event, **fields):
+    ''' log {event} with {fields} as json, nothing is formatted if {level} is disabled '''
+    if logger.isEnabledFor(level):
+        logger.log(level, '{} {}'.format(event, json2str(fields)), extra={'event': event})
+
+
+class RateLimitFilter(logging.Filter):
+    ''' token bucket per event: {burst} records at once, then {rate} records per second
+        records without an event are limited by logger, call site and level, records at {pass_level} and above always pass
+        buckets idle for {idle} seconds are evicted every {idle} seconds, their suppressed records stay in self.suppressed
+    '''
+    def __init__(self, rate=1.0, burst=5, pass_level=logging.WARNING, idle=60.0) -> None:
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.pass_level = pass_level
+        # an idle bucket is full again, evicting it changes nothing but the suppressed count of its next record
+        self.idle = max(idle, burst / rate if rate > 0 else 0)
+        # key -> [tokens, last refill time, suppressed records]
+        self.buckets = {}
+        self.suppressed = 0
+        self.evicted = 0
+        self.last_sweep = time.monotonic()
+
+    def _sweep(self, now):
+        ''' drop buckets without a record for self.idle seconds '''
+        _idle = [key for key, bucket in self.buckets.items() if now - bucket[1] > self.idle]
+        for key in _idle:
+            del self.buckets[key]
+        self.evicted += len(_idle)
+        self.last_sweep = now
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= self.pass_level:
+            return True
+        _event = getattr(record, 'event', None)
+        # messages are formatted before logging, the call site names the message
+        key = (record.name, _event) if _event is not None else (record.name, record.pathname, record.lineno, record.levelno)
+        _now = time.monotonic()
+        if _now - self.last_sweep > self.idle:
+            self._sweep(_now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, _now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (_now - bucket[1]) * self.rate)
+        bucket[1] = _now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = '{} ({} similar suppressed)'.format(record.msg, bucket[2])
+            bucket[2] = 0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    ''' queue handler dropping records when the queue is full instead of blocking or raising '''
+    def __init__(self, log_queue) -> None:
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_queue_logging(rate=1.0, burst=5, queue_size=10000):
+    ''' serve the current root handlers from a listener thread behind a rate limited queue handler
+        return the started listener, call stop_queue_logging() with it on exit
+    '''
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(RateLimitFilter(rate, burst))
+    root.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_queue_logging(listener):
+    ''' flush queued records and stop the {listener} thread '''
+    if listener is not None:
+        listener.stop()
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-import datetime as dt
 
 import threading
 import sys
@@ -11,6 +10,17 @@ import pathlib
 scriptPath = pathlib.Path(__file__).parent.resolve()
 sys.path.append(str(scriptPath.parent / 'common'))
 from jsonutils import json2str
+from frame_grabber import FrameGrabber
+from capture import open_capture, resolve_backend, LIVE_BACKENDS
+from clock import get_clock
+from preview import SnapshotPreview
+from analysis import analysis_gray, scale_area, DIFF_ENGINES, FrameHash
+from layout import LayoutCache, PopupClassifier
+from instrumentation import get_instrumentation
+from eventlog import log_event
+
+# detection events, rate limited when the wrapper logs through eventlog.start_queue_logging()
+logger = logging.getLogger('tester.detection')
 
 DET_TYPE = [
     {'frame_threshold': 5, 'threshold': 150},
@@ -20,14 +30,33 @@ DET_TYPE = [
 
 
 class TesterDetection(object):
-    def __init__(self, file, redis_conn, id, detectionType=0, displayVid=False) -> None:
+    def __init__(self, file, redis_conn, id, detectionType=0, displayVid=False, bufferSize=4, analysisScale=1.0, clock='auto', previewPeriod=0, previewDir=None, confirmPopup=False, idleFps=0, captureBackend='auto', captureOptions=None, startTime=0, instrument=False, diffEngine='frame', hashSkip=False) -> None:
         ''' init tester detection module'''
         self.redis_conn = redis_conn
         self.detType = detectionType
         self.display_video = displayVid
+        self.buffer_size = bufferSize
+        self.scale = analysisScale
+        # frame: diff against the previous frame, background: against the previous frame and a running average,
+        # keyframe: against the last frame without a significant change while idle, see analysis.DIFF_ENGINES
+        if diffEngine not in DIFF_ENGINES:
+            raise ValueError('Unknown diff engine {}, expected one of {}'.format(diffEngine, list(DIFF_ENGINES)))
+        self.diff_engine = diffEngine
+        # capture source, see capture.open_capture()
+        self.backend = resolve_backend(file, captureBackend)
+        self.capture_options = captureOptions or {}
+        # seconds into a recording where analysis starts
+        self.start_time = startTime
+        # frame timestamps for alert timing, see clock.get_clock()
+        self.clock = get_clock(clock, self.backend in LIVE_BACKENDS)
         self.id = id
         self.stage = 'idle'
 
+        # optional low rate snapshots, detection itself never draws or displays when headless
+        self.preview = None
+        if previewPeriod > 0:
+            self.preview = SnapshotPreview(previewPeriod, 'tester.{}'.format(id), redis_conn=redis_conn, out_dir=previewDir)
+
         #inits
         self.file = file
         self.new_frame_width = None
@@ -44,11 +73,46 @@ class TesterDetection(object):
         self.frame_counter = 0
         self.current_state = 0
 
+        # processed frames, read by status reporting
+        self.frame_count = 0
+        self.capture = None
+        self.grabber = None
+        self.pipeline = None
+        # bars and logo excluded from the diff, found by capture_test_screen() and checked on every frame
+        self.layout = None
+        self.layout_cache = None
+
+        # blue popup mask computed from the same decoded frame as the diff, only on changed frames
+        self.classifier = PopupClassifier()
+        # pop up needs the blue popup mask to agree with the diff
+        self.confirm_popup = confirmPopup
+
+        # frames are skipped down to {idleFps} while waiting for a pop up, 0 processes every frame
+        self.idle_period = 1 / idleFps if idleFps > 0 else 0.0
+        # frames with the cell levels of the last diffed frame skip the diff while idle or alerted, see analysis.FrameHash
+        self.hash_skip = hashSkip
+        self.frame_hash = None
+
+        # stage timing and event counters, a no-op unless {instrument} is set
+        self.instr = get_instrumentation(instrument)
+
+        # detection state and thresholds, set up by start_analysis()
+        self.popup = False
+        self.alert_time = None
+        self.scaled_min_area = None
+        self.significant_change_threshold = None
+        self.minor_change_threshold = None
+        self.mouse_change_threshold = None
+
         self.min_area = 500
 
 
         self.prev_frame_gray = None
 
+        self.th_quit = threading.Event()
+        # set when masking & comparison stopped without close(), the worker process is restarted
+        self.failed = False
+
         logging.debug('Tester Detection Module start and wait for initialization command')
 
     def load_configuration(self):
@@ -59,11 +123,10 @@ class TesterDetection(object):
         self.threshold = DET_TYPE[self.detType]['threshold']
 
         if self.frame_threshold and self.threshold:
-            print(self.frame_threshold)
-            print(self.threshold)
             CAPTURE_DONE = True
 
-        logging.debug('Configuration setting successed: {}'.format(CAPTURE_DONE))
+        logging.debug('Configuration setting successed: {}, frame threshold: {}, threshold: {}'.format(
+            CAPTURE_DONE, self.frame_threshold, self.threshold))
         self.redis_conn.publish(
             'tester.{}.result'.format(self.id),
             json2str({
@@ -76,13 +139,13 @@ class TesterDetection(object):
     def __test_screen_detection(self, frame):
 
         ''' detect test screen, return True if test screen detected, false otherwise'''
-        current_frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        current_frame_gray = analysis_gray(frame, self.scale)
         frame_diff = cv2.absdiff(current_frame_gray, self.prev_frame_gray)
         _, thresh_diff = cv2.threshold(frame_diff, self.threshold, 255, cv2.THRESH_BINARY)
 
         nonzero_pixels = cv2.countNonZero(thresh_diff)
 
-        full_screen_change = (self.frame_width * self.frame_height) * 0.5
+        full_screen_change = current_frame_gray.size * 0.5
 
         if nonzero_pixels > full_screen_change:
             self.current_state = 0
@@ -96,11 +159,10 @@ class TesterDetection(object):
         ''' capture test screen '''
         TEST_READY = False
 
-        _cap = cv2.VideoCapture(self.file)
-        _cap.open(0, apiPreference=cv2.CAP_V4L2)
+        _cap = self._open_capture()
 
         ret, prev_frame = _cap.read()
-        self.prev_frame_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY) if ret else None
+        self.prev_frame_gray = analysis_gray(prev_frame, self.scale) if ret else None
 
         ###???###
         # currTime = dt.datetime.now()
@@ -115,14 +177,18 @@ class TesterDetection(object):
         self.fps = _cap.get(cv2.CAP_PROP_FPS)
         self.fps_stop = int(self.fps * self.frame_threshold)
 
-        while not TEST_READY:
-            _, _frame = _cap.read()
+        while ret and not TEST_READY:
+            ret, _frame = _cap.read()
+            if not ret:
+                logging.error('Unable to read frame from {}, test screen not captured'.format(self.file))
+                break
             TEST_READY = self.__test_screen_detection(_frame)
-            print(TEST_READY)
             if self.display_video: cv2.imshow('testScreen', _frame)
             # _now = dt.datetime.now()
             # if _now > stopTime: break
         _cap.release()
+        if TEST_READY:
+            self.detect_layout(_frame)
         if self.display_video: cv2.destroyAllWindows()
 
         logging.debug('Configuration setting successed: {}'.format(TEST_READY))
@@ -139,7 +205,7 @@ class TesterDetection(object):
         ''' detect pop up, True if pop up detected, False otherwise '''
 
         if nonzero_pixels > significant_change_threshold and significant_change_detected:
-            print('popup detected')
+            log_event(logger, logging.DEBUG, 'popup-detected', tester=self.id, pixels=nonzero_pixels)
             return True
 
 
@@ -151,108 +217,251 @@ class TesterDetection(object):
         ''' detect user interfaction, True if detected, False otherwise '''
 
         if nonzero_pixels > minor_change_threshold and nonzero_pixels < mouse_change_threshold:
-            print('interaction detected')
+            log_event(logger, logging.DEBUG, 'interaction-detected', tester=self.id, pixels=nonzero_pixels)
             return True
 
         return False
 
 
+    def detect_layout(self, frame):
+        ''' check screen layout of {frame}, the HSV bar search only runs when the sampled bar rows changed '''
+        if self.layout_cache is None:
+            self.layout_cache = LayoutCache()
+        self.set_layout(self.layout_cache.update(frame))
+
+    def set_layout(self, layout):
+        ''' use {layout} as region of interest, the pipeline is rebuilt on the next frame if it changed '''
+        if layout is self.layout or layout == self.layout:
+            return
+        self.layout = layout
+        logging.info('Tester {} screen layout: {}'.format(self.id, layout.to_dict() if layout is not None else None))
+
+    def _build_pipeline(self, frame):
+        ''' set up analysis buffers and thresholds for the current layout and prime them with {frame} '''
+        layout = self.layout if self.layout is not None and self.layout.fits(frame) else None
+        self.pipeline = DIFF_ENGINES[self.diff_engine](frame.shape, self.threshold, self.scale, roi=layout)
+        self.pipeline.prime(frame)
+        self.classifier.reset()
+        if self.hash_skip:
+            self.frame_hash = FrameHash(frame.shape, self.threshold, roi=layout)
+            self.frame_hash.update(frame)
+        if self.stage != 'idle':
+            self._hold_reference(False)
+
+        # thresholds are fractions of the analysed pixels
+        self.scaled_min_area = scale_area(self.min_area, self.scale)
+        self.significant_change_threshold = self.pipeline.pixels * 0.001
+        self.minor_change_threshold = self.pipeline.pixels * 0.0001
+        self.mouse_change_threshold = self.pipeline.pixels * 0.0005
+
+    def _hold_reference(self, hold):
+        ''' keyframe and background engines: diff the next frames against the held reference or background if {hold}, against their previous frame otherwise '''
+        if self.diff_engine == 'frame':
+            return
+        if hold:
+            self.pipeline.hold_reference()
+        else:
+            self.pipeline.release_reference()
+
+    def start_analysis(self, frame):
+        ''' set up analysis buffers and thresholds from the first frame '''
+        self._build_pipeline(frame)
+        self.popup = False
+        self.alert_time = None
+
+    def process_frame(self, frame, now):
+        ''' run detection state machine on one frame, {now} is the frame time in seconds '''
+        self.frame_count += 1
+        self.instr.count('frames')
+
+        # frames matching the cell levels of the last diffed frame skip the diff while idle or alerted,
+        # pre-alert diffs every frame as cursor moves rarely change the levels
+        if self.frame_hash is not None and self.stage in ('idle', 'alert') and self.frame_hash.update(frame):
+            self.instr.count('hash-skips')
+            return
+
+        if self.layout_cache is not None:
+            with self.instr.span('layout'):
+                self.detect_layout(frame)
+        # layout changed, a dialog over a bar changes it too, so the frame is still diffed on the old buffers
+        # and primes the new ones afterwards
+        rebuild = self.pipeline.roi is not self.layout and (self.layout is None or self.layout.fits(frame))
+        if rebuild and not self.pipeline.fits(frame):
+            # resolution changed, this frame only primes the new buffers
+            self._build_pipeline(frame)
+            self.instr.count('layout-changes')
+            return
+
+        #process frame, change mask is kept in self.pipeline.thresh
+        with self.instr.span('diff'):
+            nonzero_pixels = self.pipeline.process(frame)
+
+        # HSV work only runs when the diff shows a change larger than a cursor, otherwise the last screen state holds
+        if self.classifier.state is None or (nonzero_pixels > self.minor_change_threshold and not self.pipeline.cursor_sized()):
+            with self.instr.span('classify'):
+                self.classifier.classify(frame, self.pipeline.roi)
+
+        # stage is logged on change only, never per frame
+        _stage = self.stage
+
+        if self.stage == 'reset':
+            self.popup = False
+            self.stage = 'idle'
+            # screen after the reset is the new reference of a pop up
+            self._hold_reference(True)
+
+        if not self.popup:
+            # region test only matters while waiting for a pop up
+            with self.instr.span('regions'):
+                significant_change_detected = self.pipeline.significant_change(nonzero_pixels, self.significant_change_threshold, self.scaled_min_area)
+            self.popup = self.__popup_detection(nonzero_pixels, significant_change_detected, self.significant_change_threshold)
+            if self.confirm_popup:
+                self.popup = self.popup and self.classifier.state == 2
+            #print('no popup')
+        if self.popup:
+            #print('yes popup')
+            if self.stage == 'idle':
+                self.redis_conn.publish(
+                    'tester.{}.result'.format(self.id),
+                    json2str({
+                        'stage': 'popUp',
+                        'status': 'success',
+                        'regions': self.pipeline.regions.tolist(),
+                        'popups': self.classifier.regions.tolist(),
+                        'screen-state': self.classifier.state,
+                    })
+                )
+                self.alert_time = now
+                self.stage = 'preAlert'
+                # interactions are cursor moves between consecutive frames
+                self._hold_reference(False)
+                self.instr.count('popUps')
+            elif self.stage == 'preAlert':
+                interaction = self.__interaction_detection(nonzero_pixels, self.minor_change_threshold, self.mouse_change_threshold)
+                # print(f'interaction:{interaction}')
+                if interaction:
+                    self.stage = 'reset'
+                    self.instr.count('interactions')
+                    self.redis_conn.publish(
+                        'tester.{}.result'.format(self.id),
+                        json2str({
+                            'stage': 'alert-reset',
+                            'status': 'success'
+                        })
+                    )
+                elif now - self.alert_time > self.frame_threshold:
+                    self.stage = 'alert'
+                    self.instr.count('alerts')
+                    self.redis_conn.publish(
+                        'tester.{}.alert'.format(self.id),
+                        json2str({
+                            'stage': 'alert',
+                            'status': 'activated'
+                        })
+                    )
+        if self.stage != _stage:
+            log_event(logger, logging.INFO, 'stage', tester=self.id, stage=self.stage, previous=_stage, time=round(now, 3))
+        if rebuild:
+            self._build_pipeline(frame)
+            self.instr.count('layout-changes')
+        else:
+            self.pipeline.advance()
+
+    def frame_period(self):
+        ''' minimum time in seconds between processed frames for the current stage
+            pre-alert needs every frame to catch short user interactions
+        '''
+        return self.idle_period if self.stage in ('idle', 'alert') else 0.0
+
+    def _open_capture(self):
+        ''' open the detection source with the configured backend '''
+        return open_capture(self.file, self.backend, **self.capture_options)
+
     def _mask_compare(self):
         ''' masking and comparison thread '''
 
-        _cap = cv2.VideoCapture(self.file)
-        _cap.open(0, apiPreference=cv2.CAP_V4L2)
+        _cap = self.capture = self._open_capture()
 
+        # frames before the start are grabbed without decoding if the file cannot seek
+        if self.start_time:
+            _cap.seek(self.start_time)
 
+        # live devices drop stale frames, recorded files must not lose any
+        self.grabber = FrameGrabber(_cap, self.clock, size=self.buffer_size, live=_cap.live)
+        self.grabber.start()
 
-        fps = _cap.get(cv2.CAP_PROP_FPS)
-        start_frame = int(fps * 1410)  # 180 seconds for 3 minutes
-        _cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-
-
-        ret, prev_frame = _cap.read()
-        self.prev_frame_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY) if ret else None
-
-        popUp = False
-        alertTime = None
+        ret, prev_frame = self.grabber.read()
+        if not ret:
+            logging.error('Unable to read frame from {}, Masking & Comparison stopped'.format(self.file))
+            self.grabber.stop()
+            _cap.release()
+            return
+        self.start_analysis(prev_frame)
 
         while True:
-            _, _frame = _cap.read()
-
-            #process frame and thresholds
-            current_frame_gray = cv2.cvtColor(_frame, cv2.COLOR_BGR2GRAY)
-            frame_diff = cv2.absdiff(current_frame_gray, self.prev_frame_gray)
-            _, thresh_diff = cv2.threshold(frame_diff, self.threshold, 255, cv2.THRESH_BINARY)
-
-            nonzero_pixels = cv2.countNonZero(thresh_diff)
-            significant_change_threshold = (self.frame_width * self.frame_height) * 0.001
-            minor_change_threshold = (self.frame_width * self.frame_height) * 0.0001
-            mouse_change_threshold = (self.frame_width * self.frame_height) * 0.0005
-
-            contours, _ = cv2.findContours(thresh_diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            significant_change_detected = any(cv2.contourArea(contour) > self.min_area for contour in contours)
-            
-            self.prev_frame_gray = current_frame_gray
-            
-            print(self.stage)
-            
-            if self.stage == 'reset':
-                popUp = False
-                self.stage = 'idle'
-                print ('******* popUp: {}, stage: {}'.format(popUp, self.stage))
-
-            if not popUp:
-                popUp = self.__popup_detection(nonzero_pixels, significant_change_detected, significant_change_threshold)
-                #print('no popup')
-            if popUp:
-                #print('yes popup')
-                if self.stage == 'idle':
-                    self.redis_conn.publish(
-                        'tester.{}.result'.format(self.id),
-                        json2str({
-                            'stage': 'popUp',
-                            'status': 'success'
-                        })
-                    )
-                    alertTime = dt.datetime.now()
-                    self.stage = 'preAlert'
-                elif self.stage == 'preAlert':
-                    interaction = self.__interaction_detection(nonzero_pixels, minor_change_threshold, mouse_change_threshold)
-                    # print(f'interaction:{interaction}')
-                    if interaction:
-                        self.stage = 'reset'
-                        self.redis_conn.publish(
-                            'tester.{}.result'.format(self.id),
-                            json2str({
-                                'stage': 'alert-reset',
-                                'status': 'success'
-                            })
-                        )
-                    else:
-                        _now = dt.datetime.now()
-                        _diff = _now - alertTime
-                        if _diff.total_seconds() > self.frame_threshold:
-                            self.stage = 'alert'
-                            self.redis_conn.publish(
-                                'tester.{}.alert'.format(self.id),
-                                json2str({
-                                    'stage': 'alert',
-                                    'status': 'activated'
-                                })
-                            )
+            with self.instr.span('wait'):
+                ret, _frame = self.grabber.read()
+            if not ret:
+                break
+            with self.instr.span('frame'):
+                self.process_frame(_frame, self.grabber.timestamp)
+            self.grabber.set_period(self.frame_period())
+            if self.preview is not None:
+                self.preview.update(_frame, self.grabber.timestamp)
+
             if self.display_video: cv2.imshow('Masking', _frame)
             if self.th_quit.is_set():
                 break
+        self.grabber.stop()
         _cap.release()
         if self.display_video: cv2.destroyAllWindows()
         logging.debug('Masking & Comparison stopped')
 
+    def _run_mask_compare(self):
+        ''' masking and comparison thread, flags a failure if it stops before close() '''
+        try:
+            self._mask_compare()
+        except Exception:
+            logging.exception('Masking & Comparison failed on {}'.format(self.file))
+            self.failed = True
+            if self.grabber is not None:
+                self.grabber.stop()
+            if self.capture is not None:
+                self.capture.release()
+            return
+        # live sources do not end, stopping without close() means the device was lost
+        if not self.th_quit.is_set() and self.backend in LIVE_BACKENDS:
+            self.failed = True
+
     def start_mask_compare(self):
         ''' start masking and compare '''
-        self.th_quit = threading.Event()
-        self.th = threading.Thread(target=self._mask_compare)
+        self.th = threading.Thread(target=self._run_mask_compare)
         self.th.start()
 
+    def get_status(self):
+        ''' return a dict describing current detection status '''
+        _status = {
+            'stage': self.stage,
+            'frames': self.frame_count,
+        }
+        if self.grabber is not None:
+            _status.update(self.grabber.get_status())
+        if self.capture is not None:
+            _status.update(self.capture.get_status())
+        if self.pipeline is not None:
+            _status.update(self.pipeline.get_status())
+        if self.frame_hash is not None:
+            _status.update(self.frame_hash.get_status())
+        _status['screen-state'] = self.classifier.state
+        _status['classified'] = self.classifier.invocations
+        if self.layout is not None:
+            _status['layout'] = self.layout.to_dict()
+        if self.layout_cache is not None:
+            _status.update(self.layout_cache.get_status())
+        if self.instr.enabled:
+            _status['instrumentation'] = self.instr.summary()
+        return _status
+
     def set_alert_stage(self, stage, status=False):
         ''' setting of alert stage '''
         if status:  
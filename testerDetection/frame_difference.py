@@ -4,8 +4,10 @@ from argparse import ArgumentParser
 import pathlib
 import time
 
+from analysis import analysis_gray, scale_area, large_regions, to_display
 
-def frame_difference2(filename):
+
+def frame_difference2(filename, scale=1.0):
     # Open the video
     cap = cv2.VideoCapture(filename)
 
@@ -29,9 +31,9 @@ def frame_difference2(filename):
 
     # Read the first frame
     ret, prev_frame = cap.read()
-    prev_frame_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY) if ret else None
+    prev_frame_gray = analysis_gray(prev_frame, scale) if ret else None
 
-    min_area = 5000
+    min_area = scale_area(5000, scale)
     current_state = 0
 
     while ret and frame_count < end_frame_number:
@@ -44,23 +46,20 @@ def frame_difference2(filename):
             break  # Break the loop if there are no more frames
 
         #finding absolute difference
-        current_frame_gray = cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY)
+        current_frame_gray = analysis_gray(current_frame, scale)
         frame_diff = cv2.absdiff(current_frame_gray, prev_frame_gray)
         _, thresh_diff = cv2.threshold(frame_diff, 50, 255, cv2.THRESH_BINARY)
 
-        #contouring
-        contours, _ = cv2.findContours(thresh_diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        #connected regions larger than min_area
+        significant_change_detected, boxes = large_regions(thresh_diff, min_area)
 
         # Process the frame
-        significant_change_threshold = (frame_width * frame_height) * 0.001
-        significant_change_detected = False
+        significant_change_threshold = scale_area((frame_width * frame_height) * 0.001, scale)
 
-        for contour in contours:
-            if cv2.contourArea(contour) > min_area:
-                significant_change_detected = True
-                x, y, w, h = cv2.boundingRect(contour)
-                # Draw the rectangle on the current frame to visualize the change
-                cv2.rectangle(current_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)  # Green rectangle
+        for box in boxes:
+            x, y, w, h = [int(v / scale) for v in box]
+            # Draw the rectangle on the current frame to visualize the change
+            cv2.rectangle(current_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)  # Green rectangle
 
         nonzero_pixels = cv2.countNonZero(thresh_diff)
 
@@ -87,7 +86,7 @@ def frame_difference2(filename):
         #     text_color = (0, 0, 255)
 
         # Prepare the frame for display and output file
-        thresh_diff_bgr = cv2.cvtColor(thresh_diff, cv2.COLOR_GRAY2BGR)
+        thresh_diff_bgr = to_display(thresh_diff, current_frame)
         concatenated_frame = cv2.hconcat([current_frame, thresh_diff_bgr])
         cv2.putText(concatenated_frame, display_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, text_color, 2)
 
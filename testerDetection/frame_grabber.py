@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+frame_grabber.py
+Capture thread filling a bounded ring buffer of preallocated frames
+'''
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class FrameGrabber(object):
+    ''' read frames from an opened capture in a dedicated thread
+        live sources drop the oldest buffered frame when the buffer is full,
+        file sources block the capture thread until the consumer catches up
+        every frame is stamped by {clock} when captured
+        frames closer than {period} seconds to the last kept frame are grabbed but never decoded
+    '''
+    def __init__(self, cap, clock, size=4, live=True) -> None:
+        if size < 2:
+            raise ValueError('Frame buffer needs at least 2 slots, got {}'.format(size))
+        self.cap = cap
+        self.clock = clock
+        self.size = size
+        self.live = live
+
+        # slot indexes: free for capture, filled waiting for consumer, current held by consumer
+        self.slots = []
+        self.stamps = [0.0] * size
+        self.free = deque()
+        self.filled = deque()
+        self.current = None
+        # timestamp of the frame returned by the last read()
+        self.timestamp = 0.0
+
+        self.cond = threading.Condition()
+        self.eof = False
+        self.captured = 0
+        self.dropped = 0
+        self.skipped = 0
+        # minimum time between kept frames, 0 keeps every frame
+        self.period = 0.0
+        self.last_stamp = None
+
+        self.th_quit = threading.Event()
+        self.th = None
+
+    def start(self):
+        ''' read first frame to size the buffer and start capture thread '''
+        ret, frame = self.cap.read()
+        if not ret:
+            logging.error('Unable to read first frame, frame grabber not started')
+            self.eof = True
+            return False
+        self.slots = [frame] + [np.empty_like(frame) for _ in range(self.size - 1)]
+        self.stamps[0] = self.last_stamp = self.clock.stamp(self.cap)
+        self.filled.append(0)
+        self.free.extend(range(1, self.size))
+        self.captured = 1
+
+        self.th = threading.Thread(target=self._capture)
+        self.th.start()
+        logging.debug('Frame grabber started with {} slots of {} ({})'.format(
+            self.size, frame.shape, 'drop-oldest' if self.live else 'block'))
+        return True
+
+    def _take_free_slot(self):
+        ''' return a free slot index for capture, None if quitting '''
+        with self.cond:
+            if not self.free:
+                if self.live:
+                    self.free.append(self.filled.popleft())
+                    self.dropped += 1
+                else:
+                    self.cond.wait_for(lambda: self.free or self.th_quit.is_set())
+                    if self.th_quit.is_set():
+                        return None
+            return self.free.popleft()
+
+    def set_period(self, period):
+        ''' keep at most one frame every {period} seconds, 0 to keep every frame '''
+        self.period = period
+
+    def _capture(self):
+        ''' capture thread '''
+        while not self.th_quit.is_set():
+            if not self.cap.grab():
+                with self.cond:
+                    self.eof = True
+                    self.cond.notify_all()
+                break
+            _stamp = self.clock.stamp(self.cap)
+            if self.period and _stamp - self.last_stamp < self.period:
+                # skipped frames are not decoded
+                self.skipped += 1
+                continue
+            self.last_stamp = _stamp
+
+            _idx = self._take_free_slot()
+            if _idx is None:
+                break
+            ret, frame = self.cap.retrieve(self.slots[_idx])
+            with self.cond:
+                if not ret:
+                    self.free.append(_idx)
+                    self.eof = True
+                    self.cond.notify_all()
+                    break
+                # capture may reallocate when the source resolution changes
+                self.slots[_idx] = frame
+                self.stamps[_idx] = _stamp
+                self.filled.append(_idx)
+                self.captured += 1
+                self.cond.notify_all()
+        logging.debug('Frame grabber stopped: {} captured, {} dropped, {} skipped'.format(self.captured, self.dropped, self.skipped))
+
+    def read(self, timeout=None):
+        ''' return (ret, frame) like cv2.VideoCapture.read()
+            the frame is only valid until the next call of read(), its capture time is in self.timestamp
+        '''
+        with self.cond:
+            if self.current is not None:
+                self.free.append(self.current)
+                self.current = None
+                self.cond.notify_all()
+            self.cond.wait_for(lambda: self.filled or self.eof or self.th_quit.is_set(), timeout)
+            if not self.filled:
+                return False, None
+            self.current = self.filled.popleft()
+            self.timestamp = self.stamps[self.current]
+            return True, self.slots[self.current]
+
+    def get_status(self):
+        ''' return capture counters '''
+        with self.cond:
+            return {
+                'captured': self.captured,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+                'buffered': len(self.filled),
+            }
+
+    def stop(self):
+        ''' stop capture thread, the capture itself is released by the owner '''
+        with self.cond:
+            self.th_quit.set()
+            self.cond.notify_all()
+        if self.th is not None:
+            self.th.join()
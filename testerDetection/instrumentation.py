@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+instrumentation.py
+Per stage timing spans and event counters of the detection loop
+
+    with instr.span('diff'):
+        nonzero_pixels = pipeline.process(frame)
+    instr.count('popUp')
+
+Spans are timed with the monotonic performance counter and the last
+{window} durations of every stage are kept as a rolling histogram.
+NullInstrumentation has the same interface and does nothing, so a
+disabled detector only pays for a method call per span
+'''
+import time
+from collections import deque
+
+import numpy as np
+
+
+class _Span(object):
+    ''' reusable timer of one stage, not re-entrant '''
+    __slots__ = ('samples', 'start')
+
+    def __init__(self, samples) -> None:
+        self.samples = samples
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan(object):
+    ''' span doing nothing '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Instrumentation(object):
+    ''' rolling histograms of stage durations and event counters
+        spans and counters are created on first use, summary() is safe to call from another thread
+    '''
+    enabled = True
+
+    def __init__(self, window=512) -> None:
+        self.window = window
+        self.spans = {}
+        self.counters = {}
+        self.started = time.monotonic()
+
+    def span(self, name):
+        ''' return context manager timing stage {name} '''
+        _span = self.spans.get(name)
+        if _span is None:
+            _span = self.spans[name] = _Span(deque(maxlen=self.window))
+        return _span
+
+    def count(self, name, n=1):
+        ''' add {n} to counter {name} '''
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        ''' return compact dict of counters and p50 / p99 / max of every stage in ms '''
+        _stages = {}
+        for name, _span in list(self.spans.items()):
+            # copy is atomic, the detection thread may append meanwhile
+            _samples = np.array(_span.samples.copy()) * 1000
+            if not len(_samples):
+                continue
+            p50, p99 = np.percentile(_samples, [50, 99])
+            _stages[name] = {
+                'n': len(_samples),
+                'p50-ms': round(float(p50), 3),
+                'p99-ms': round(float(p99), 3),
+                'max-ms': round(float(_samples.max()), 3),
+            }
+        return {
+            'uptime': round(time.monotonic() - self.started, 1),
+            'counters': dict(self.counters),
+            'stages': _stages,
+        }
+
+    def reset(self):
+        ''' drop collected samples and counters '''
+        self.spans.clear()
+        self.counters.clear()
+        self.started = time.monotonic()
+
+
+class NullInstrumentation(object):
+    ''' disabled instrumentation, same interface as Instrumentation '''
+    enabled = False
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def count(self, name, n=1):
+        pass
+
+    def summary(self):
+        return None
+
+    def reset(self):
+        pass
+
+
+def get_instrumentation(enabled=False, window=512):
+    ''' return Instrumentation if {enabled}, NullInstrumentation otherwise '''
+    return Instrumentation(window) if enabled else NullInstrumentation()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+layout.py
+Tester screen layout found with the HSV thresholds of popup_detection.py
+
+The blue full width bars at the top and bottom of the tester screen hold the
+clock and status text, and the logo never changes. Both are excluded from the
+frame difference through a region of interest computed once per layout
+'''
+import logging
+
+import cv2
+import numpy as np
+
+# blue bars, first masking operation of popup_detection.mask_and_detect_popups
+BAR_HSV = (np.array([50, 120, 50]), np.array([140, 255, 255]))
+# blue popups and logo, second masking operation
+POPUP_HSV = (np.array([50, 100, 0]), np.array([140, 255, 255]))
+# contour area of the panasonic logo in capture pixels
+LOGO_AREA = (21000, 21500)
+
+
+def find_bars(frame, hsv=None):
+    ''' return (top_y, bottom_y), the rows between the full width blue bars
+        frame edges are returned when a bar is not found
+    '''
+    if hsv is None:
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, *BAR_HSV)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    top_y = 0
+    bottom_y = frame.shape[0]
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w > frame.shape[1] * 0.99:
+            if y < frame.shape[0] // 2:
+                top_y = max(top_y, y + h)
+            else:
+                bottom_y = min(bottom_y, y)
+    return top_y, bottom_y
+
+
+def find_logos(hsv_cropped):
+    ''' return Nx4 array of x, y, w, h of logo contours in the cropped HSV frame '''
+    mask = cv2.inRange(hsv_cropped, *POPUP_HSV)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [cv2.boundingRect(c) for c in contours if LOGO_AREA[0] <= cv2.contourArea(c) <= LOGO_AREA[1]]
+    return np.array(boxes, np.int32).reshape(-1, 4)
+
+
+class ScreenLayout(object):
+    ''' rows between the blue bars and logo boxes of one tester screen
+        logo boxes are relative to the top_y row
+    '''
+    def __init__(self, shape, top_y, bottom_y, logos=None) -> None:
+        self.shape = tuple(shape[:2])
+        self.top_y = top_y
+        self.bottom_y = bottom_y
+        self.logos = np.empty((0, 4), np.int32) if logos is None else logos
+
+    @classmethod
+    def detect(cls, frame):
+        ''' find layout of {frame}, None if the bars do not leave a valid crop '''
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        top_y, bottom_y = find_bars(frame, hsv)
+        if bottom_y <= top_y:
+            logging.warning('Invalid crop dimensions {}:{}, no screen layout'.format(top_y, bottom_y))
+            return None
+        layout = cls(frame.shape, top_y, bottom_y, find_logos(hsv[top_y:bottom_y]))
+        logging.debug('Screen layout detected: {}'.format(layout.to_dict()))
+        return layout
+
+    def fits(self, frame):
+        ''' True if the layout was detected at the resolution of {frame} '''
+        return frame.shape[:2] == self.shape
+
+    def roi_mask(self, size):
+        ''' return exclusion mask of the cropped rows resized to {size} (width, height), None without logos
+            the mask is 255 where pixels are analysed and 0 over the logos
+        '''
+        if not len(self.logos):
+            return None
+        mask = np.full((self.bottom_y - self.top_y, self.shape[1]), 255, np.uint8)
+        for x, y, w, h in self.logos:
+            mask[y:y + h, x:x + w] = 0
+        if (mask.shape[1], mask.shape[0]) != size:
+            mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+        return mask
+
+    def to_dict(self):
+        ''' return layout as a json friendly dict '''
+        return {
+            'top': int(self.top_y),
+            'bottom': int(self.bottom_y),
+            'logos': self.logos.tolist(),
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, ScreenLayout):
+            return NotImplemented
+        return self.shape == other.shape and self.top_y == other.top_y and self.bottom_y == other.bottom_y \
+            and np.array_equal(self.logos, other.logos)
+
+
+class LayoutCache(object):
+    ''' keep the layout of a video, detected again only when a signature of a few sampled rows changes
+        sampled rows lie inside the blue bars, so popups and scrolling logs between the bars do not trigger detection
+    '''
+    def __init__(self, step=8, pixel_threshold=40, tolerance=0.05) -> None:
+        self.step = step
+        self.pixel_threshold = pixel_threshold
+        self.tolerance = tolerance
+        self.layout = None
+        self.shape = None
+        self.rows = None
+        self.signature = None
+        self.checks = 0
+        self.detections = 0
+
+    def _sample_rows(self, height):
+        ''' rows of the signature: last row of the top bar and first row of the bottom bar,
+            fixed rows near the frame edges while no bar is known
+        '''
+        rows = []
+        if self.layout is not None and self.layout.top_y > 0:
+            rows.append(self.layout.top_y - 1)
+        else:
+            rows.append(height // 50)
+        if self.layout is not None and self.layout.bottom_y < height:
+            rows.append(self.layout.bottom_y)
+        else:
+            rows.append(height - 1 - height // 50)
+        return rows
+
+    def _sample(self, frame):
+        ''' return signature of {frame} '''
+        return frame[self.rows, ::self.step]
+
+    def changed(self, frame):
+        ''' True if {frame} does not match the signature of the cached layout '''
+        if self.signature is None or frame.shape[:2] != self.shape:
+            return True
+        _diff = cv2.absdiff(self._sample(frame), self.signature).max(axis=-1)
+        return np.count_nonzero(_diff > self.pixel_threshold) > self.tolerance * _diff.size
+
+    def update(self, frame):
+        ''' return layout of {frame}, running the HSV bar search only when the signature changed '''
+        self.checks += 1
+        if self.changed(frame):
+            self.detections += 1
+            self.layout = ScreenLayout.detect(frame)
+            self.shape = frame.shape[:2]
+            self.rows = self._sample_rows(frame.shape[0])
+            self.signature = self._sample(frame)
+        return self.layout
+
+    def get_status(self):
+        ''' return layout check counters '''
+        return {
+            'layout-checks': self.checks,
+            'layout-detections': self.detections,
+        }
+
+
+class PopupClassifier(object):
+    ''' second masking operation of popup_detection.mask_and_detect_popups on reused buffers
+        blue regions larger than 10000 pixels are counted, except the logo and the full screen
+        state 0: no tester screen, 1: tester screen, 2: tester screen with popups
+    '''
+    def __init__(self) -> None:
+        self.hsv = None
+        self.mask = None
+        self.state = None
+        self.popups = 0
+        # boxes of every counted blue region, x, y, w, h in capture coordinates
+        self.regions = np.empty((0, 4), np.int32)
+        self.invocations = 0
+
+    def classify(self, frame, layout=None):
+        ''' classify {frame} cropped above the bottom bar of {layout}, return the state '''
+        # top bar is kept in the crop, as in popup_detection
+        cropped = frame[:layout.bottom_y] if layout is not None else frame
+        if self.hsv is None or self.hsv.shape != cropped.shape:
+            self.hsv = np.empty(cropped.shape, np.uint8)
+            self.mask = np.empty(cropped.shape[:2], np.uint8)
+        cv2.cvtColor(cropped, cv2.COLOR_BGR2HSV, dst=self.hsv)
+        cv2.inRange(self.hsv, *POPUP_HSV, dst=self.mask)
+        contours, _ = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        boxes = []
+        for contour in contours:
+            area = cv2.contourArea(contour)
+            if area > 10000 and not (LOGO_AREA[0] <= area <= LOGO_AREA[1]) and not area >= 780000:
+                boxes.append(cv2.boundingRect(contour))
+        self.regions = np.array(boxes, np.int32).reshape(-1, 4)
+        self.invocations += 1
+
+        if len(boxes) < 1:
+            self.state = 0
+        elif len(boxes) == 1:
+            self.state = 1
+        else:
+            self.state = 2
+        self.popups = max(len(boxes) - 1, 0)
+        return self.state
+
+    def reset(self):
+        ''' forget the last state so the next frame is classified '''
+        self.state = None
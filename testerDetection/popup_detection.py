@@ -4,6 +4,9 @@ import os
 from argparse import ArgumentParser
 import pathlib
 
+from layout import LayoutCache, PopupClassifier
+from analysis import DiffPipeline
+
 #Step 1: Obtain frame data from the test videos
 
 #Capture Video and Read Img/Frames
@@ -120,9 +123,9 @@ def detect_and_draw_popups(video_path):
 
 
 #Step 4: Total Code
-def mask_and_detect_popups(video_path, output_dir):
-    #capture video
-    cap = cv2.VideoCapture(video_path)
+def mask_and_detect_popups(video_path, output_dir, gate_threshold=30, gate_fraction=0.0001, gate_scale=0.25, display=True):
+    #capture video, or use an already opened capture
+    cap = video_path if hasattr(video_path, 'read') else cv2.VideoCapture(video_path)
 
     # Get the frames per second of the video
     fps = cap.get(cv2.CAP_PROP_FPS)
@@ -131,6 +134,15 @@ def mask_and_detect_popups(video_path, output_dir):
     prev_state = None
     frame_counter = 0
 
+    # bar positions are only searched again when the sampled bar rows change
+    layout_cache = LayoutCache()
+
+    # popups are only classified again when the gray diff shows a change, static frames keep the last state
+    classifier = PopupClassifier()
+    pipeline = None
+    minute = 0
+    minute_invocations = 0
+
     screenshots_dir = os.path.join(output_dir, 'screenshots')
     os.makedirs(screenshots_dir, exist_ok=True)
     output_file = os.path.join(output_dir, 'output.txt')
@@ -147,86 +159,67 @@ def mask_and_detect_popups(video_path, output_dir):
             frame_counter += 1
             timestamp = frame_counter / fps
 
-            # First masking operation based on one blue color range
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-            lower_blue_first = np.array([50, 120, 50])
-            upper_blue_first = np.array([140, 255, 255])
-            mask_first = cv2.inRange(hsv, lower_blue_first, upper_blue_first)
-            contours_first, _ = cv2.findContours(mask_first, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            top_y = 0
-            bottom_y = frame.shape[0]
-
-            for contour in contours_first:
-                x, y, w, h = cv2.boundingRect(contour)
-                if w > frame.shape[1] * 0.99:
-                    if y < frame.shape[0] // 2:
-                        # top_y = max(top_y, y + h)
-                        continue
-                    else:
-                        bottom_y = min(bottom_y, y)
-
-            if bottom_y > top_y:
-                cropped_image = frame[top_y:bottom_y, :]
-
-                # Second masking operation for detecting popups on the cropped frame
-                hsv_cropped = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2HSV)
-                lower_blue_second = np.array([50, 100, 0])
-                upper_blue_second = np.array([140, 255, 255])
-                mask_second = cv2.inRange(hsv_cropped, lower_blue_second, upper_blue_second)
-                contours_second, _ = cv2.findContours(mask_second, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                cnts = 0
-
-                for contour in contours_second:
-                    area = cv2.contourArea(contour)
-                    # print(area)
-                    # if 21200 <= area <= 21300:
-                    #     x, y, w, h = cv2.boundingRect(contour)
-                    #     cv2.rectangle(cropped_image, (x, y), (x + w, y + h), (255, 255, 255), -1)
-
-                    if area > 10000 and not (21000 <= area <= 21500) and not area >= 780000: #area of the panasonic logo
-                        cnts += 1
-                        x, y, w, h = cv2.boundingRect(contour)
-                        # Drawing in green for visibility
-                        cv2.rectangle(cropped_image, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-
-                # print(f'Large number of contours detected in current frame: {cnts}')
-                if cnts < 1:
-                    current_state = 'State 0: No Tester Screen'
-                elif cnts == 1:
-                    current_state = 'State 1: Tester Screen'
-                else:
-                    current_state = f'State 2: {cnts - 1} PopUp Detected'
-
-                # Print the current state only if it has changed since the last check
-                if current_state != prev_state:
-                    print(current_state)
-                    file.write(f"{timestamp:.2f}s: {current_state}\n")
-
-                    if cnts > 1:
-                        image_filename = f"frame_{frame_counter}_popup_detected.jpg"
-                        image_path = os.path.join(screenshots_dir, image_filename)
-                        cv2.imwrite(image_path, frame)  # Save the frame as an image file
-                        print(f"Saved screenshot: {image_path}")
-
-                    prev_state = current_state
-
-
-                cv2.imshow('Detected Popups on Cropped Image', cropped_image if 'cropped_image' in locals() else frame)
-
-            # else:
-            #     # print("Invalid crop dimensions. Skipping frame.")
-            #     # continue
-            #     cv2.imshow('Detected Popups on Cropped Image', frame)
-
-
+            # First masking operation based on one blue color range, cached until the layout changes
+            layout = layout_cache.update(frame)
+
+            # Gate: small gray diff against the previous frame, bars and logo of the layout are left out
+            if pipeline is None or pipeline.roi is not layout:
+                # layout changed, the gate is rebuilt as in final_algo.TesterDetection._build_pipeline
+                pipeline = DiffPipeline(frame.shape, gate_threshold, gate_scale, roi=layout)
+                pipeline.prime(frame)
+                changed = True
+            else:
+                # cursor sized changes cannot open or close a popup
+                changed = pipeline.process(frame) > pipeline.pixels * gate_fraction and not pipeline.cursor_sized()
+                pipeline.advance()
+
+            # Second masking operation for detecting popups on the cropped frame
+            if changed or classifier.state is None:
+                classifier.classify(frame, layout)
+
+            # top bar is kept in the crop
+            cropped_image = frame[:layout.bottom_y] if layout is not None else frame
+            if display:
+                for x, y, w, h in classifier.regions:
+                    # Drawing in green for visibility
+                    cv2.rectangle(cropped_image, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+            if classifier.state == 0:
+                current_state = 'State 0: No Tester Screen'
+            elif classifier.state == 1:
+                current_state = 'State 1: Tester Screen'
+            else:
+                current_state = f'State 2: {classifier.popups} PopUp Detected'
+
+            # Print the current state only if it has changed since the last check
+            if current_state != prev_state:
+                print(current_state)
+                file.write(f"{timestamp:.2f}s: {current_state}\n")
+
+                if classifier.state == 2:
+                    image_filename = f"frame_{frame_counter}_popup_detected.jpg"
+                    image_path = os.path.join(screenshots_dir, image_filename)
+                    cv2.imwrite(image_path, frame)  # Save the frame as an image file
+                    print(f"Saved screenshot: {image_path}")
+
+                prev_state = current_state
+
+            # classifier invocations per minute of video
+            if int(timestamp // 60) > minute:
+                print(f'Minute {minute}: popup classifier ran {classifier.invocations - minute_invocations} times')
+                minute = int(timestamp // 60)
+                minute_invocations = classifier.invocations
+
+            if display:
+                cv2.imshow('Detected Popups on Cropped Image', cropped_image)
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     break
 
         cap.release()
-        cv2.destroyAllWindows()
+        if display: cv2.destroyAllWindows()
+        print(f'Minute {minute}: popup classifier ran {classifier.invocations - minute_invocations} times')
+        print(f'Popup classifier ran {classifier.invocations} times in {frame_counter} frames')
+        print('Layout detected {layout-detections} times in {layout-checks} frames'.format(**layout_cache.get_status()))
 
 
 
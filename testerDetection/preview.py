@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+preview.py
+Low rate JPEG snapshots of the detection input for headless nodes
+'''
+import sys
+import base64
+import logging
+import pathlib
+import datetime as dt
+
+import cv2
+
+scriptPath = pathlib.Path(__file__).parent.resolve()
+sys.path.append(str(scriptPath.parent / 'common'))
+from jsonutils import json2str
+
+
+class SnapshotPreview(object):
+    ''' save a JPEG snapshot every {period} seconds to redis key '<prefix>.preview' and/or {out_dir}
+        the redis value is json: {'timestamp': ..., 'jpeg': <base64>}
+    '''
+    def __init__(self, period, prefix, redis_conn=None, out_dir=None, quality=70, scale=0.5) -> None:
+        self.period = period
+        self.prefix = prefix
+        self.redis_conn = redis_conn
+        self.out_dir = pathlib.Path(out_dir) if out_dir else None
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.scale = scale
+        self.last = None
+        self.count = 0
+        if self.out_dir is not None:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    def update(self, frame, now):
+        ''' write a snapshot of {frame} if {period} seconds passed since the last one '''
+        if self.last is not None and now - self.last < self.period:
+            return False
+        self.last = now
+
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode('.jpg', frame, self.params)
+        if not ret:
+            logging.error('Unable to encode preview snapshot for {}'.format(self.prefix))
+            return False
+
+        if self.redis_conn is not None:
+            self.redis_conn.set('{}.preview'.format(self.prefix), json2str({
+                'timestamp': dt.datetime.now(),
+                'jpeg': base64.b64encode(jpeg.tobytes()).decode('ascii'),
+            }))
+        if self.out_dir is not None:
+            # overwrite so the directory always holds the latest snapshot only
+            (self.out_dir / '{}.jpg'.format(self.prefix)).write_bytes(jpeg.tobytes())
+        self.count += 1
+        return True
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+replay.py
+Headless replay of recorded tester videos through the final_algo state machine
+
+Frames are decoded as fast as possible and the detection uses the frame
+timestamps instead of the wall clock. Every video produces a timeline of
+popUp / alert-reset / alert events, written as JSON to the output directory
+
+    python3 replay.py /path/to/videos --output /path/to/timelines --workers 4
+'''
+import sys
+import time
+import json
+import logging
+import pathlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+
+scriptPath = pathlib.Path(__file__).parent.resolve()
+sys.path.append(str(scriptPath.parent / 'common'))
+from jsonutils import str2json
+from final_algo import TesterDetection
+from capture import open_capture
+from analysis import DIFF_ENGINES
+
+VIDEO_EXT = ['.mp4', '.avi', '.mkv', '.mov']
+TIMELINE_STAGES = ['popUp', 'alert-reset', 'alert']
+
+
+class EventRecorder(object):
+    ''' stands in for the redis connection and records detection results at the replay time '''
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.events = []
+
+    def publish(self, ch, msg):
+        ''' record msg published on channel {ch} '''
+        msg = str2json(msg)
+        if msg.get('stage') in TIMELINE_STAGES:
+            self.events.append({'time': round(self.now, 3), 'channel': ch, **msg})
+
+
+def replay_video(video_path, detectionType=0, analysisScale=1.0, ackAfter=None, confirmPopup=False, idleFps=0, diffEngine='frame', hashSkip=False):
+    ''' replay {video_path} through TesterDetection and return its event timeline
+        ackAfter: seconds after an alert to simulate the operator reset switch, None to never reset
+    '''
+    recorder = EventRecorder()
+    algo = TesterDetection(video_path, recorder, pathlib.Path(video_path).stem,
+        detectionType=detectionType, analysisScale=analysisScale, clock='capture', confirmPopup=confirmPopup, idleFps=idleFps,
+        diffEngine=diffEngine, hashSkip=hashSkip)
+    algo.load_configuration()
+
+    cap = open_capture(video_path, 'file')
+    ret, frame = cap.read()
+    if not ret:
+        logging.error('Unable to read video {}'.format(video_path))
+        return {'video': str(video_path), 'frames': 0, 'events': []}
+
+    _start = time.perf_counter()
+    # live nodes detect the layout in capture_test_screen()
+    algo.detect_layout(frame)
+    algo.start_analysis(frame)
+    _last = algo.clock.stamp(cap)
+    while True:
+        if not cap.grab():
+            break
+        recorder.now = algo.clock.stamp(cap)
+        # frames skipped by the detection are not decoded, as with the live frame grabber
+        if recorder.now - _last < algo.frame_period():
+            continue
+        _last = recorder.now
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        algo.process_frame(frame, recorder.now)
+        if ackAfter is not None and algo.stage == 'alert' and recorder.now - recorder.events[-1]['time'] >= ackAfter:
+            algo.set_alert_stage('alert-reset', status=True)
+    _elapsed = time.perf_counter() - _start
+    cap.release()
+
+    logging.info('{}: {} frames, {:.1f}s of video in {:.1f}s, {} events'.format(
+        video_path, algo.frame_count, recorder.now, _elapsed, len(recorder.events)))
+    return {
+        'video': str(video_path),
+        'frames': algo.frame_count,
+        'duration': round(recorder.now, 3),
+        'replay-time': round(_elapsed, 3),
+        'speed': round(recorder.now / _elapsed, 2) if _elapsed else None,
+        **cap.get_status(),
+        'events': recorder.events,
+    }
+
+
+def replay_directory(video_dir, output_dir=None, workers=None, **kw):
+    ''' replay every video in {video_dir} on a process pool, optionally saving one timeline per video '''
+    videos = sorted(p for p in pathlib.Path(video_dir).iterdir() if p.suffix.lower() in VIDEO_EXT)
+    if output_dir is not None:
+        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(replay_video, str(v), **kw) for v in videos]
+        for future in futures:
+            results.append(future.result())
+            if output_dir is not None:
+                save_timeline(results[-1], output_dir)
+    return results
+
+
+def save_timeline(result, output_dir):
+    ''' save replay result as <output_dir>/<video name>.json '''
+    with open(pathlib.Path(output_dir) / '{}.json'.format(pathlib.Path(result['video']).stem), 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Replay recorded tester videos through the detection state machine')
+    parser.add_argument('videos', type=str, help='video file or directory of videos')
+    parser.add_argument('--output', type=str, default=None, help='directory for per-video timeline json')
+    parser.add_argument('--workers', type=int, default=None, help='number of replay processes')
+    parser.add_argument('--type', type=int, default=0, help='detection type, index of final_algo.DET_TYPE')
+    parser.add_argument('--scale', type=float, default=1.0, help='analysis scale')
+    parser.add_argument('--ack-after', type=float, default=-1, help='seconds before a simulated alert reset, negative to never reset as replay_video() does by default')
+    parser.add_argument('--idle-fps', type=float, default=0, help='processed frames per second while idle, 0 for every frame')
+    parser.add_argument('--confirm-popup', action='store_true', help='pop up also needs a blue popup in the HSV mask')
+    parser.add_argument('--engine', type=str, default='frame', choices=list(DIFF_ENGINES), help='change detection engine')
+    parser.add_argument('--hash-skip', action='store_true', help='skip frames with the cell levels of the last diffed frame while idle')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s %(processName)s %(levelname)s]: %(message)s')
+
+    _kw = {
+        'detectionType': args.type,
+        'analysisScale': args.scale,
+        'ackAfter': args.ack_after if args.ack_after >= 0 else None,
+        'confirmPopup': args.confirm_popup,
+        'idleFps': args.idle_fps,
+        'diffEngine': args.engine,
+        'hashSkip': args.hash_skip,
+    }
+    if pathlib.Path(args.videos).is_dir():
+        results = replay_directory(args.videos, args.output, args.workers, **_kw)
+    else:
+        results = [replay_video(args.videos, **_kw)]
+        if args.output is not None:
+            pathlib.Path(args.output).mkdir(parents=True, exist_ok=True)
+            save_timeline(results[0], args.output)
+    for result in results:
+        print(result['video'])
+        for event in result['events']:
+            print('  {:>10.3f}s  {}'.format(event['time'], event['stage']))
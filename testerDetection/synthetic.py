@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+synthetic.py
+Synthetic tester screen videos with ground truth labels
+
+The screen has a grey title bar, a blue task bar with a running clock,
+the blue tester panel and logo, a scrolling log and a mouse cursor. Popup
+dialogs with buttons open at random times on the grey background below
+the panel, the operator clicks some of them within the pre-alert window
+and leaves the others to raise an alert. The panel is the only blue
+region of the idle screen, so layout.PopupClassifier sees state 1 when
+idle and state 2 while a dialog is open
+
+    python3 synthetic.py /path/to/videos --count 4 --duration 60 --width 1920 --height 1080
+
+Every video <name>.avi comes with <name>.json holding the scene events
+and the detection events expected from final_algo when every alert is
+reset at once, as replay.py does with --ack-after 0. The log text, the
+cursor and its speed keep a log scroll out of the interaction and popup
+ranges and a cursor move inside the interaction range, so the labels
+hold at any resolution and detection type. final_algo also reports the
+closing of a dialog as a popUp, these events and the ones following from
+them are labelled with 'trigger': 'close'. With --confirm-popup,
+final_algo only reports the events without a trigger. With --over-bar,
+dialogs cover the task bar and change the screen layout while they are
+open
+'''
+import json
+import logging
+import pathlib
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+
+# white cursor outline differs from the background by less than the lowest detection threshold
+BACKGROUND = (210, 210, 210)
+TITLE = (60, 60, 60)
+BAR = (255, 0, 0)
+PANEL = (200, 90, 30)
+# dark enough to differ from the grey background by more than the detection thresholds in gray
+POPUP = (140, 30, 0)
+BUTTON = (235, 235, 235)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+# log text has the same pixel size at any resolution, its glyphs stay below the min_area of final_algo,
+# and full lines make a scroll change a fixed fraction of the frame, above the interaction range
+LOG_FONT_SCALE = 0.4
+LOG_LINE_HEIGHT = 20
+
+
+class TesterScreen(object):
+    ''' render frame {index} of a synthetic tester screen with render(index)
+        the scene is drawn from {seed}, self.events holds the scene events and self.expected the detection events
+        popups are answered with probability {interact}, unanswered popups are expected to alert after {alert_after} seconds
+    '''
+    def __init__(self, width=1920, height=1080, fps=30, duration=60, seed=0, interact=0.5, alert_after=5,
+            log_period=1.0, over_bar=False) -> None:
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.duration = duration
+        self.alert_after = alert_after
+        self.log_period = log_period
+        self.rng = np.random.default_rng(seed)
+        self.unit = height / 1080
+
+        self.bar = max(int(40 * self.unit), 2)
+        self.font_scale = 0.5 * self.unit
+        self.log_box = (int(width * 0.58), int(height * 0.08), int(width * 0.40), int(height * 0.68))
+        self.log_rows = self.log_box[3] // LOG_LINE_HEIGHT
+        # columns of log entries filling the width of the log, apart enough for their changes not to connect
+        self.log_column_width = cv2.getTextSize(self._log_entry(0), FONT, LOG_FONT_SCALE, 1)[0][0] + 20
+        self.log_columns = max((self.log_box[2] - 10) // self.log_column_width, 1)
+        self.log_step = -1
+        self.log_image = None
+
+        self.base = self._draw_base()
+        self.popup_image, self.button = self._draw_popup()
+        # dialogs open on the grey background, apart from the panel contour
+        self.popup_pos = (int(width * 0.15), int(height * 0.55))
+        if over_bar:
+            # or cover the task bar down to the frame edge, the bar is no longer found and the layout changes
+            self.popup_pos = (self.popup_pos[0], height - self.popup_image.shape[0])
+        # arrow of a desktop at 200% scaling, at most 150% so the change of a moving cursor stays below the min_area of final_algo
+        self.cursor = (np.array([[0, 0], [0, 19], [5, 14], [12, 14]]) * min(2 * self.unit, 1.5)).astype(np.int32)
+        # a moving cursor covers its own height every frame, so its changes in consecutive frames do not overlap
+        # and every move is a change in the interaction range of final_algo
+        self.cursor_step = int(self.cursor[:, 1].max()) + 2
+        self.frame = np.empty_like(self.base)
+
+        # scene: (start, end) of popups, and cursor paths as (start, end, from, to)
+        self.popups = []
+        self.paths = []
+        self.events = []
+        self.expected = []
+        self._plan(interact)
+
+    def _draw_base(self):
+        ''' static part of the screen '''
+        base = np.full((self.height, self.width, 3), BACKGROUND, np.uint8)
+        # title bar is not blue, it is kept in the popup classifier crop and must not count as a region
+        base[:self.bar] = TITLE
+        base[-self.bar:] = BAR
+        cv2.putText(base, 'SDU CT Tester', (10, int(self.bar * 0.7)), FONT, self.font_scale * 1.2, (255, 255, 255), 1, cv2.LINE_AA)
+        # tester panel stays below the full screen area excluded by popup_detection and leaves room for dialogs below it
+        # capped below the 780000 pixel full screen area at high resolutions
+        _x, _y = int(self.width * 0.02), int(self.height * 0.08)
+        base[_y:_y + min(int(self.height * 0.42), 460), _x:_x + min(int(self.width * 0.52), 1000)] = PANEL
+        # logo below the log, contour area of 250 x 86 pixels is inside layout.LOGO_AREA at any resolution
+        # small screens have no room for it above the task bar
+        _y = int(self.height * 0.80)
+        if _y + 86 < self.height - self.bar:
+            base[_y:_y + 86, self.width - 260:self.width - 10] = BAR
+        return base
+
+    def _draw_popup(self):
+        ''' popup dialog with OK and Cancel buttons, return image and OK button center in dialog coordinates '''
+        w, h = int(self.width * 0.30), int(self.height * 0.25)
+        popup = np.full((h, w, 3), POPUP, np.uint8)
+        cv2.rectangle(popup, (0, 0), (w - 1, h - 1), (255, 255, 255), 2)
+        cv2.putText(popup, 'Test step failed, retry?', (int(w * 0.08), int(h * 0.3)), FONT, self.font_scale * 1.4, (255, 255, 255), 1, cv2.LINE_AA)
+        bw, bh = int(w * 0.25), int(h * 0.2)
+        for i, text in enumerate(['OK', 'Cancel']):
+            x, y = int(w * (0.15 + i * 0.45)), int(h * 0.65)
+            popup[y:y + bh, x:x + bw] = BUTTON
+            cv2.putText(popup, text, (x + bw // 4, y + int(bh * 0.65)), FONT, self.font_scale * 1.2, (0, 0, 0), 1, cv2.LINE_AA)
+        return popup, (int(w * 0.15) + bw // 2, int(h * 0.65) + bh // 2)
+
+    def _random_point(self):
+        ''' random cursor position on the grey background below the dialogs '''
+        return (int(self.rng.uniform(0.05, 0.5) * self.width), int(self.rng.uniform(0.84, 0.9) * self.height))
+
+    def _path(self, start, _from, _to):
+        ''' cursor path from {_from} to {_to} starting at {start} '''
+        _frames = max(np.ceil(np.hypot(_to[0] - _from[0], _to[1] - _from[1]) / self.cursor_step), 1)
+        return (start, start + _frames / self.fps, _from, _to)
+
+    def _plan(self, interact):
+        ''' draw popup times, operator answers and idle cursor moves '''
+        t = self.rng.uniform(3, 8)
+        cursor = self._random_point()
+        while t + self.alert_after + 4 < self.duration:
+            # idle cursor move before the popup
+            if self.rng.random() < 0.5 and t > 2:
+                _to = self._random_point()
+                self.paths.append(self._path(t - 2, cursor, _to))
+                self.events.append({'time': round(t - 2, 3), 'event': 'cursor'})
+                cursor = _to
+
+            start = t
+            self.events.append({'time': round(start, 3), 'event': 'popup'})
+            self.expected.append({'time': round(start, 3), 'stage': 'popUp'})
+            if self.rng.random() < interact:
+                # operator moves to the OK button and clicks it before the alert
+                _move = start + self.rng.uniform(1, self.alert_after - 2)
+                _button = (self.popup_pos[0] + self.button[0], self.popup_pos[1] + self.button[1])
+                self.paths.append(self._path(_move, cursor, _button))
+                end = _move + 1.2
+                self.events.append({'time': round(_move, 3), 'event': 'interaction'})
+                self.expected.append({'time': round(_move, 3), 'stage': 'alert-reset'})
+                # and moves away once the popup closed
+                cursor = self._random_point()
+                self.paths.append(self._path(end + 0.5, _button, cursor))
+                self.events.append({'time': round(end + 0.5, 3), 'event': 'cursor'})
+                # closing is a popUp, moving away resets it
+                self.expected.append({'time': round(end, 3), 'stage': 'popUp', 'trigger': 'close'})
+                self.expected.append({'time': round(end + 0.5, 3), 'stage': 'alert-reset', 'trigger': 'close'})
+                gap = self.rng.uniform(5, 15)
+            else:
+                # nobody answers, popup times out after the alert
+                end = start + self.alert_after + self.rng.uniform(2, 4)
+                self.expected.append({'time': round(start + self.alert_after, 3), 'stage': 'alert'})
+                # closing is a popUp nobody answers either, the next popup opens after its alert
+                self.expected.append({'time': round(end, 3), 'stage': 'popUp', 'trigger': 'close'})
+                if end + self.alert_after < self.duration:
+                    self.expected.append({'time': round(end + self.alert_after, 3), 'stage': 'alert', 'trigger': 'close'})
+                gap = self.rng.uniform(self.alert_after + 3, 15)
+            self.popups.append((start, end))
+            self.events.append({'time': round(end, 3), 'event': 'close'})
+            t = end + gap
+        self.rest = cursor
+
+    def _log_entry(self, n):
+        ''' log entry {n} '''
+        _rng = np.random.default_rng(n)
+        return '[{:05d}] STEP {:04d} {} V={:.3f}'.format(n, _rng.integers(10000), 'PASS' if _rng.random() < 0.9 else 'FAIL', _rng.uniform(3, 3.6))
+
+    def _draw_log(self, t):
+        ''' log panel image, redrawn when it scrolls '''
+        step = int(t / self.log_period)
+        if step != self.log_step:
+            self.log_step = step
+            x, y, w, h = self.log_box
+            self.log_image = np.full((h, w, 3), 255, np.uint8)
+            # the log is full from the first frame
+            _first = (step - self.log_rows + 1) % 10000 * self.log_columns
+            for i in range(self.log_rows):
+                for j in range(self.log_columns):
+                    cv2.putText(self.log_image, self._log_entry(_first + i * self.log_columns + j),
+                        (5 + j * self.log_column_width, (i + 1) * LOG_LINE_HEIGHT - 5), FONT, LOG_FONT_SCALE, (0, 0, 0), 1, cv2.LINE_AA)
+        return self.log_image
+
+    def _cursor_at(self, t):
+        ''' cursor position at time {t} '''
+        pos = self.paths[0][2] if self.paths else self.rest
+        for start, end, _from, _to in self.paths:
+            if t < start:
+                break
+            if t >= end:
+                pos = _to
+                continue
+            _f = (t - start) / (end - start)
+            return (int(_from[0] + (_to[0] - _from[0]) * _f), int(_from[1] + (_to[1] - _from[1]) * _f))
+        return pos
+
+    def render(self, index):
+        ''' return frame {index}, the returned buffer is reused by the next call '''
+        t = index / self.fps
+        np.copyto(self.frame, self.base)
+
+        x, y, w, h = self.log_box
+        self.frame[y:y + h, x:x + w] = self._draw_log(t)
+        _clock = '{:02d}:{:02d}:{:02d}'.format(int(t // 3600) + 8, int(t // 60) % 60, int(t) % 60)
+        cv2.putText(self.frame, _clock, (self.width - int(120 * self.unit), self.height - int(self.bar * 0.3)),
+            FONT, self.font_scale * 1.2, (255, 255, 255), 1, cv2.LINE_AA)
+
+        if any(start <= t < end for start, end in self.popups):
+            x, y = self.popup_pos
+            ph, pw = self.popup_image.shape[:2]
+            self.frame[y:y + ph, x:x + pw] = self.popup_image
+
+        cursor = self.cursor + self._cursor_at(t)
+        cv2.fillPoly(self.frame, [cursor], (0, 0, 0))
+        cv2.polylines(self.frame, [cursor], True, (255, 255, 255), 1)
+        return self.frame
+
+    def labels(self):
+        ''' return ground truth of the video '''
+        return {
+            'width': self.width,
+            'height': self.height,
+            'fps': self.fps,
+            'duration': self.duration,
+            'events': self.events,
+            'expected': self.expected,
+        }
+
+
+def write_video(path, fourcc='MJPG', **kw):
+    ''' render a synthetic video to {path} and its labels to the json file next to it, return the labels '''
+    screen = TesterScreen(**kw)
+    path = pathlib.Path(path)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), screen.fps, (screen.width, screen.height))
+    if not writer.isOpened():
+        logging.error('Unable to open video writer for {}'.format(path))
+        return None
+    for index in range(int(screen.duration * screen.fps)):
+        writer.write(screen.render(index))
+    writer.release()
+
+    labels = screen.labels()
+    with open(path.with_suffix('.json'), 'w') as f:
+        json.dump(labels, f, indent=2)
+    logging.info('{}: {} popups, {} expected events'.format(path, len(screen.popups), len(labels['expected'])))
+    return labels
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Render synthetic tester screen videos with ground truth labels')
+    parser.add_argument('output', type=str, help='output directory')
+    parser.add_argument('--count', type=int, default=1, help='number of videos')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--duration', type=float, default=60, help='seconds per video')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first video, next videos use seed + i')
+    parser.add_argument('--interact', type=float, default=0.5, help='probability the operator answers a popup')
+    parser.add_argument('--over-bar', action='store_true', help='dialogs cover the task bar')
+    parser.add_argument('--fourcc', type=str, default='MJPG')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    pathlib.Path(args.output).mkdir(parents=True, exist_ok=True)
+    for i in range(args.count):
+        write_video(pathlib.Path(args.output) / 'synthetic_{}x{}_{}.avi'.format(args.width, args.height, args.seed + i),
+            fourcc=args.fourcc, width=args.width, height=args.height, fps=args.fps, duration=args.duration,
+            seed=args.seed + i, interact=args.interact, over_bar=args.over_bar)